@@ -0,0 +1,110 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Compare parsing the arguments of commands with five or more arguments one argument at a time
+and with the compiled per-handler parser.
+
+Run from the repository root with ``python -m benchmarks.command_args``. The one at a time
+variant is the loop that ``CommandHandler.__parse_args__`` used before the compiled parser,
+which calls ``Argument.match`` with the stripped remaining text for every argument.
+"""
+
+from __future__ import annotations
+
+from typing import Any
+import argparse
+import asyncio
+import time
+
+from maubot.handlers import command
+from maubot.handlers.command import ArgumentSyntaxError, CommandHandler
+
+
+def parse_int(val: str) -> int:
+    if not val.isdigit():
+        raise ArgumentSyntaxError(f"{val} is not a number")
+    return int(val)
+
+
+class Commands:
+    @command.new("six")
+    @command.argument("a")
+    @command.argument("b", matches=r"[a-z]+")
+    @command.argument("c", parser=parse_int)
+    @command.argument("d", required=False, matches=r"(\d+)-(\d+)")
+    @command.argument("e", required=False)
+    @command.argument("rest", pass_raw=True, required=False)
+    async def six(self, evt: Any, **kwargs: Any) -> None:
+        pass
+
+    @command.new("eight")
+    @command.argument("a1")
+    @command.argument("a2")
+    @command.argument("a3", matches=r"\d+")
+    @command.argument("a4")
+    @command.argument("a5", parser=str.upper)
+    @command.argument("a6")
+    @command.argument("a7", matches="foo|bar")
+    @command.argument("a8", required=False)
+    async def eight(self, evt: Any, **kwargs: Any) -> None:
+        pass
+
+
+CASES = [
+    ("6 args", "six", "hello world 42 12-34 eee the rest of it"),
+    ("8 args", "eight", "a b 3 d e f foo tail and some more words"),
+    ("8 args + 2 KB text", "eight", "a b 3 d e f foo " + "word " * 400),
+]
+
+
+async def parse_one_at_a_time(handler: CommandHandler, remaining_val: str) -> dict[str, Any]:
+    call_args = {}
+    for arg in handler.__mb_arguments__:
+        remaining_val, call_args[arg.name] = arg.match(
+            remaining_val.strip(), evt=None, instance=handler.__bound_instance__
+        )
+        if arg.required and call_args[arg.name] is None:
+            raise ValueError("Argument required")
+    return call_args
+
+
+async def parse_compiled(handler: CommandHandler, remaining_val: str) -> dict[str, Any]:
+    call_args = {}
+    ok, _ = await handler.__parse_args__(None, call_args, remaining_val)
+    assert ok
+    return call_args
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    commands = Commands()
+    print(f"{'command':20} {'one at a time':>14} {'compiled':>10}")
+    for label, name, body in CASES:
+        handler = getattr(commands, name)
+        assert await parse_one_at_a_time(handler, body) == await parse_compiled(handler, body)
+        results = []
+        for parse in (parse_one_at_a_time, parse_compiled):
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                await parse(handler, body)
+            results.append((time.perf_counter() - start) / args.iterations * 1_000_000)
+        print(f"{label:20} {results[0]:11.1f} us {results[1]:7.1f} us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
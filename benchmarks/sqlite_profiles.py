@@ -0,0 +1,113 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Compare the SQLite pragma profiles from the example config on typical plugin workloads.
+
+Run from the repository root with ``python -m benchmarks.sqlite_profiles``. The database is
+created in a temporary directory, so pass ``--dir`` to measure a specific disk.
+"""
+
+from __future__ import annotations
+
+from typing import Any
+import argparse
+import asyncio
+import os.path
+import tempfile
+import time
+
+from ruamel.yaml import YAML
+
+from maubot.lib.sqlite_tuning import SQLiteMaintenance, profile_init_commands
+from mautrix.util.async_db import Database
+
+WRITES = 2000
+POINT_READS = 5000
+ROOM_SCANS = 200
+ROOMS = 50
+
+# SQLite's own defaults, for comparison with the profiles
+BASELINE_PROFILES = {"sqlite default (DELETE journal, FULL)": {"journal_mode": "DELETE"}}
+
+
+def load_profiles() -> dict[str, dict[str, Any]]:
+    path = os.path.join(os.path.dirname(__file__), "..", "maubot", "example-config.yaml")
+    with open(path) as file:
+        config = YAML(typ="safe").load(file)
+    return {**BASELINE_PROFILES, **config["plugin_databases"]["sqlite_profiles"]}
+
+
+async def run(directory: str, profile: dict[str, Any]) -> dict[str, float]:
+    db = Database.create(
+        f"sqlite:{os.path.join(directory, 'bench.db')}",
+        db_args={"init_commands": profile_init_commands(profile)},
+    )
+    await db.start()
+    try:
+        await db.execute(
+            "CREATE TABLE kv (room TEXT, key TEXT, value TEXT, PRIMARY KEY (room, key))"
+        )
+        results = {}
+        start = time.perf_counter()
+        for i in range(WRITES):
+            await db.execute(
+                "INSERT INTO kv VALUES ($1, $2, $3) "
+                "ON CONFLICT (room, key) DO UPDATE SET value=excluded.value",
+                f"!room{i % ROOMS}",
+                f"key{i}",
+                "v" * 200,
+            )
+        results["writes/s"] = WRITES / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(POINT_READS):
+            await db.fetchrow(
+                "SELECT value FROM kv WHERE room=$1 AND key=$2",
+                f"!room{i % ROOMS}",
+                f"key{i % WRITES}",
+            )
+        results["point reads/s"] = POINT_READS / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(ROOM_SCANS):
+            await db.fetch("SELECT key, value FROM kv WHERE room=$1", f"!room{i % ROOMS}")
+        results["room scans/s"] = ROOM_SCANS / (time.perf_counter() - start)
+        maintenance = SQLiteMaintenance(0, lambda: [("bench", db)])
+        start = time.perf_counter()
+        await maintenance.run_once()
+        results["maintenance ms"] = (time.perf_counter() - start) * 1000
+        return results
+    finally:
+        await db.stop()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dir", help="directory to create the databases in")
+    args = parser.parse_args()
+    print(
+        f"{'profile':40} {'writes/s':>10} {'point reads/s':>14} {'room scans/s':>13} "
+        f"{'maintenance ms':>15}"
+    )
+    for name, profile in load_profiles().items():
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            res = await run(directory, profile)
+        print(
+            f"{name:40} {res['writes/s']:10.0f} {res['point reads/s']:14.0f} "
+            f"{res['room scans/s']:13.0f} {res['maintenance ms']:15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Compare loading clients and plugin instances at startup one by one and with a single query.
+
+Run from the repository root with ``python -m benchmarks.startup``. Clients and instances are
+loaded from a SQLite database in a temporary directory, with a stub plugin loader, so only the
+database and cache work is measured. Clients aren't started.
+"""
+
+from __future__ import annotations
+
+from types import SimpleNamespace
+import argparse
+import asyncio
+import os.path
+import tempfile
+import time
+
+from maubot.client import Client
+from maubot.config import Config
+from maubot.db import init as init_db, upgrade_table
+from maubot.instance import PluginInstance
+from maubot.lib.state_store import PgStateStore
+from maubot.loader import PluginLoader
+from mautrix.util.async_db import Database
+
+
+class StubLoader:
+    def __init__(self) -> None:
+        self.references = set()
+        self.meta = SimpleNamespace(webapp=False)
+
+
+async def load_one_by_one() -> None:
+    # The startup sequence before Client.load_all and PluginInstance.load_all
+    await asyncio.gather(*[plugin.load() async for plugin in PluginInstance.all()])
+    _ = [client async for client in Client.all()]
+    async for plugin in PluginInstance.all():
+        await plugin.load()
+
+
+async def load_all() -> None:
+    await Client.load_all()
+    await PluginInstance.load_all()
+
+
+async def run(directory: str, clients: int, instances: int) -> dict[str, float]:
+    db = Database.create(
+        f"sqlite:{os.path.join(directory, 'maubot.db')}", upgrade_table=upgrade_table
+    )
+    init_db(db)
+    await db.start()
+    try:
+        async with db.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO client (id, homeserver, access_token, device_id, enabled, "
+                "                    next_batch, filter_id, sync, autojoin, online, "
+                "                    displayname, avatar_url) "
+                "VALUES ($1, 'https://example.com', 'token', '', true, '', '', true, false, "
+                "        true, '', '')",
+                [(f"@bot{i}:example.com",) for i in range(clients)],
+            )
+            await conn.executemany(
+                "INSERT INTO instance (id, type, enabled, primary_user, config) "
+                "VALUES ($1, 'stub', true, $2, '')",
+                [(f"instance{i}", f"@bot{i % clients}:example.com") for i in range(instances)],
+            )
+        path = os.path.join(os.path.dirname(__file__), "..", "maubot", "example-config.yaml")
+        config = Config(path, path)
+        config.load()
+        maubot = SimpleNamespace(
+            config=config,
+            loop=asyncio.get_running_loop(),
+            state_store=PgStateStore(db),
+            crypto_db=None,
+            crypto_db_pickle_key=None,
+        )
+        Client.init_cls(maubot)
+        PluginInstance.init_cls(maubot)
+        PluginLoader.id_cache["stub"] = StubLoader()
+        results = {}
+        for name, load in (("one by one", load_one_by_one), ("load_all", load_all)):
+            Client.cache.clear()
+            PluginInstance.cache.clear()
+            start = time.perf_counter()
+            await load()
+            results[name] = time.perf_counter() - start
+            assert len(Client.cache) == clients and len(PluginInstance.cache) == instances
+            for client in Client.cache.values():
+                await client.http_client.close()
+        return results
+    finally:
+        await db.stop()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000, help="number of clients")
+    parser.add_argument("--instances", type=int, default=5000, help="number of instances")
+    parser.add_argument("--dir", help="directory to create the database in")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        results = await run(directory, args.clients, args.instances)
+    print(f"{args.clients} clients, {args.instances} instances")
+    for name, duration in results.items():
+        print(f"{name:12} {duration:8.3f} s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
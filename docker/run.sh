@@ -17,6 +17,7 @@ function fixconfig {
 	fixdefault '.plugin_directories.upload' './plugins' '/data/plugins'
 	fixdefault '.plugin_directories.load[0]' './plugins' '/data/plugins'
 	fixdefault '.plugin_directories.trash' './trash' '/data/trash'
+	fixdefault '.plugin_directories.history' './history' '/data/history'
 	fixdefault '.plugin_databases.sqlite' './plugins' '/data/dbs'
 	fixdefault '.plugin_databases.sqlite' './dbs' '/data/dbs'
 	fixdefault '.logging.handlers.file.filename' './maubot.log' '/var/log/maubot.log'
@@ -26,7 +27,7 @@ function fixconfig {
 
 cd /opt/maubot
 
-mkdir -p /var/log/maubot /data/plugins /data/trash /data/dbs
+mkdir -p /var/log/maubot /data/plugins /data/trash /data/history /data/dbs
 
 if [ ! -f /data/config.yaml ]; then
 	cp example-config.yaml /data/config.yaml
@@ -28,7 +28,10 @@ from .config import Config
 from .db import init as init_db, upgrade_table
 from .instance import PluginInstance
 from .lib.future_awaitable import FutureAwaitable
-from .lib.state_store import PgStateStore
+from .lib.loop_monitor import LoopMonitor
+from .lib.plugin_db import SQLiteThreadPool
+from .lib.sqlite_tuning import SQLiteMaintenance
+from .lib.state_store import CachedPgStateStore, PgStateStore
 from .loader.zip import init as init_zip_loader
 from .management.api import init as init_mgmt_api
 from .server import MaubotServer
@@ -46,7 +49,10 @@ class Maubot(Program):
     crypto_db: Database | None
     crypto_db_pickle_key: str = "mau.crypto"
     plugin_postgres_db: PostgresDatabase | None
+    plugin_sqlite_threads: SQLiteThreadPool | None
     state_store: PgStateStore
+    loop_monitor: LoopMonitor | None
+    sqlite_maintenance: SQLiteMaintenance | None
 
     config_class = Config
     module = "maubot"
@@ -122,6 +128,14 @@ class Maubot(Program):
         else:
             self.plugin_postgres_db = None
 
+        if self.config["plugin_databases.sqlite_shared_threads"] > 0:
+            self.plugin_sqlite_threads = SQLiteThreadPool(
+                self.config["plugin_databases.sqlite_shared_threads"],
+                max_busy_timeout=self.config["plugin_databases.sqlite_shared_busy_timeout"],
+            )
+        else:
+            self.plugin_sqlite_threads = None
+
     def prepare(self) -> None:
         super().prepare()
 
@@ -135,7 +149,28 @@ class Maubot(Program):
         PluginInstance.init_cls(self)
         management_api = init_mgmt_api(self.config, self.loop)
         self.server = MaubotServer(management_api, self.config, self.loop)
-        self.state_store = PgStateStore(self.db)
+        dedup_size = self.config["state_store.dedup_size"]
+        if self.config["state_store.cache_size"] > 0:
+            self.state_store = CachedPgStateStore(
+                self.db, cache_size=self.config["state_store.cache_size"], dedup_size=dedup_size
+            )
+        else:
+            self.state_store = PgStateStore(self.db, dedup_size=dedup_size)
+        if self.config["loop_monitor.enabled"]:
+            self.loop_monitor = LoopMonitor(
+                self.loop,
+                interval=self.config["loop_monitor.interval"],
+                threshold=self.config["loop_monitor.threshold"],
+            )
+        else:
+            self.loop_monitor = None
+        if self.config["plugin_databases.sqlite_maintenance_interval"] > 0:
+            self.sqlite_maintenance = SQLiteMaintenance(
+                self.config["plugin_databases.sqlite_maintenance_interval"],
+                PluginInstance.sqlite_databases,
+            )
+        else:
+            self.sqlite_maintenance = None
 
     async def start_db(self) -> None:
         self.log.debug("Starting database...")
@@ -165,13 +200,16 @@ class Maubot(Program):
             await self.db.stop()
 
     async def start(self) -> None:
+        if self.loop_monitor:
+            self.loop_monitor.start()
         await self.start_db()
-        await asyncio.gather(*[plugin.load() async for plugin in PluginInstance.all()])
-        await asyncio.gather(*[client.start() async for client in Client.all()])
+        clients = await Client.load_all()
+        await PluginInstance.load_all()
+        await asyncio.gather(*[client.start() for client in clients])
         await super().start()
-        async for plugin in PluginInstance.all():
-            await plugin.load()
         await self.server.start()
+        if self.sqlite_maintenance:
+            self.sqlite_maintenance.start()
 
     async def stop(self) -> None:
         self.add_shutdown_actions(*(client.stop() for client in Client.cache.values()))
@@ -181,6 +219,12 @@ class Maubot(Program):
             await asyncio.wait_for(self.server.stop(), 5)
         except asyncio.TimeoutError:
             self.log.warning("Stopping server timed out")
+        if self.sqlite_maintenance:
+            self.sqlite_maintenance.stop()
+        if self.loop_monitor:
+            self.loop_monitor.stop()
+        if self.plugin_sqlite_threads:
+            self.plugin_sqlite_threads.stop()
         await self.db.stop()
 
 
@@ -48,6 +48,8 @@ from mautrix.util.async_getter_lock import async_getter_lock
 from mautrix.util.logging import TraceLogger
 
 from .db import Client as DBClient
+from .lib.coalesce import SendCoalescer
+from .lib.send_scheduler import RateLimitAwareHTTPAPI, SendScheduler
 from .matrix import MaubotMatrixClient
 
 try:
@@ -123,18 +125,29 @@ class Client(DBClient):
     def _make_client(
         self, homeserver: str | None = None, token: str | None = None, device_id: str | None = None
     ) -> MaubotMatrixClient:
-        return MaubotMatrixClient(
-            mxid=self.id,
+        api = RateLimitAwareHTTPAPI(
             base_url=homeserver or self.homeserver,
             token=token or self.access_token,
             client_session=self.http_client,
             log=self.log,
-            crypto_log=self.log.getChild("crypto"),
             loop=self.maubot.loop,
+        )
+        client = MaubotMatrixClient(
+            mxid=self.id,
+            api=api,
+            crypto_log=self.log.getChild("crypto"),
             device_id=device_id or self.device_id,
             sync_store=self,
             state_store=self.maubot.state_store,
         )
+        if self.maubot.config["send_limits.enabled"]:
+            client.send_scheduler = SendScheduler.from_config(
+                self.id, self.maubot.config["send_limits"]
+            )
+        client.coalescer = SendCoalescer.from_config(
+            client._send_scheduled, self.maubot.config["send_coalescing"]
+        )
+        return client
 
     def postinit(self) -> None:
         if self._postinited:
@@ -334,6 +347,10 @@ class Client(DBClient):
             self.started = False
             await self.stop_plugins()
             self.stop_sync()
+            if self.client.coalescer:
+                await self.client.coalescer.flush_all()
+            if self.client.send_scheduler:
+                self.client.send_scheduler.stop()
             if self.crypto:
                 await self.crypto_store.close()
 
@@ -517,6 +534,10 @@ class Client(DBClient):
         new_client.event_handlers = self.client.event_handlers
         new_client.global_event_handlers = self.client.global_event_handlers
 
+        if self.client.coalescer:
+            await self.client.coalescer.flush_all()
+        if self.client.send_scheduler:
+            self.client.send_scheduler.stop()
         self.client = new_client
         self.homeserver = homeserver
         self.access_token = access_token
@@ -579,6 +600,22 @@ class Client(DBClient):
 
         return None
 
+    @classmethod
+    async def load_all(cls) -> list[Client]:
+        """
+        Load all clients into the cache with a single query. Unlike :meth:`get`, this doesn't take
+        the per-ID lock, so it must only be used at startup before anything else loads clients.
+        """
+        clients = []
+        user: cls
+        for user in await super().all():
+            try:
+                clients.append(cls.cache[user.id])
+            except KeyError:
+                user.postinit()
+                clients.append(user)
+        return clients
+
     @classmethod
     async def all(cls) -> AsyncGenerator[Client, None]:
         users = await super().all()
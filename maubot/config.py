@@ -32,6 +32,7 @@ class Config(BaseFileConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         base = helper.base
         copy = helper.copy
+        copy_dict = helper.copy_dict
 
         if "database" in self and self["database"].startswith("sqlite:///"):
             helper.base["database"] = self["database"].replace("sqlite:///", "sqlite:")
@@ -44,15 +45,26 @@ class Config(BaseFileConfig):
         else:
             copy("crypto_database")
         copy("crypto_db_pickle_key")
+        copy("state_store.cache_size")
+        copy("state_store.dedup_size")
         copy("plugin_directories.upload")
         copy("plugin_directories.load")
         copy("plugin_directories.trash")
+        copy("plugin_directories.history")
+        copy("plugin_directories.history_size")
+        copy("plugin_upgrades.health_check_delay")
+        copy("plugin_upgrades.max_failure_ratio")
         if "plugin_directories.db" in self:
             base["plugin_databases.sqlite"] = self["plugin_directories.db"]
         else:
             copy("plugin_databases.sqlite")
         copy("plugin_databases.postgres")
         copy("plugin_databases.postgres_opts")
+        copy_dict("plugin_databases.sqlite_profiles")
+        copy_dict("plugin_databases.sqlite_instance_profiles")
+        copy("plugin_databases.sqlite_shared_threads")
+        copy("plugin_databases.sqlite_shared_busy_timeout")
+        copy("plugin_databases.sqlite_maintenance_interval")
         copy("server.hostname")
         copy("server.port")
         copy("server.public_url")
@@ -60,6 +72,7 @@ class Config(BaseFileConfig):
         copy("server.ui_base_path")
         copy("server.plugin_base_path")
         copy("server.override_resource_path")
+        copy("server.max_request_size")
         shared_secret = self["server.unshared_secret"]
         if shared_secret is None or shared_secret == "generate":
             base["server.unshared_secret"] = self._new_token()
@@ -77,6 +90,26 @@ class Config(BaseFileConfig):
                 base["admins"][username] = bcrypt.hashpw(
                     password.encode("utf-8"), bcrypt.gensalt()
                 ).decode("utf-8")
+        copy("send_limits.enabled")
+        copy("send_limits.room_rate")
+        copy("send_limits.room_burst")
+        copy("send_limits.global_rate")
+        copy("send_limits.global_burst")
+        copy("send_limits.max_retries")
+        copy("send_coalescing.edit_window")
+        copy("send_coalescing.notice_window")
+        copy("send_coalescing.notice_max_length")
+        copy("event_handling.max_concurrent")
+        copy("event_handling.queue_size")
+        copy("event_handling.shed_policy")
+        copy("event_handling.serialize_rooms")
+        copy_dict("event_handling.instance_overrides")
+        copy("loop_monitor.enabled")
+        copy("loop_monitor.interval")
+        copy("loop_monitor.threshold")
+        copy("metrics.enabled")
+        copy("metrics.hostname")
+        copy("metrics.listen_port")
         copy("api_features.login")
         copy("api_features.plugin")
         copy("api_features.plugin_upload")
@@ -87,6 +120,7 @@ class Config(BaseFileConfig):
         copy("api_features.client_auth")
         copy("api_features.dev_open")
         copy("api_features.log")
+        copy("api_features.profiler")
         copy("logging")
 
     def is_admin(self, user: str) -> bool:
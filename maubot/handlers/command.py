@@ -32,10 +32,12 @@ from abc import ABC, abstractmethod
 import asyncio
 import functools
 import inspect
+import math
 import re
 
 from mautrix.types import EventType, MessageType
 
+from ..lib.token_bucket import TokenBucketStore
 from ..matrix import MaubotMessageEvent
 from . import event
 
@@ -59,6 +61,99 @@ def _split_in_two(val: str, split_by: str) -> List[str]:
     return val.split(split_by, 1) if split_by in val else [val, ""]
 
 
+# Shared by all commands of all plugin instances. Buckets are keyed by the instance ID, the
+# command function and the sender or room, so the number of keys is effectively unbounded.
+rate_limit_store = TokenBucketStore(max_size=50000)
+
+
+class CommandRateLimit:
+    rate: float
+    burst: float
+    per: str
+    message: Optional[str]
+    command_id: str
+
+    def __init__(
+        self, func: CommandHandlerFunc, rate: float, burst: float, per: str, message: Optional[str]
+    ) -> None:
+        if per not in ("sender", "room"):
+            raise ValueError(f"Invalid rate limit key {per!r}, must be 'sender' or 'room'")
+        self.rate = rate
+        self.burst = burst
+        self.per = per
+        self.message = message
+        self.command_id = f"{func.__module__}.{func.__qualname__}"
+
+    @classmethod
+    def create(
+        cls,
+        func: CommandHandlerFunc,
+        cooldown: Optional[float],
+        rate: Optional[Tuple[int, float]],
+        per: str,
+        message: Optional[str],
+    ) -> Optional["CommandRateLimit"]:
+        if cooldown is not None and rate is not None:
+            raise ValueError("Only one of cooldown and rate can be specified")
+        elif cooldown is not None:
+            if cooldown <= 0:
+                raise ValueError(f"Invalid cooldown {cooldown!r}, must be positive")
+            return cls(func, rate=1 / cooldown, burst=1, per=per, message=message)
+        elif rate is not None:
+            try:
+                count, seconds = rate
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Invalid rate {rate!r}, must be a (count, seconds) tuple") from e
+            if count < 1 or seconds <= 0:
+                raise ValueError(
+                    f"Invalid rate {rate!r}, count must be at least 1 and seconds must be positive"
+                )
+            return cls(func, rate=count / seconds, burst=count, per=per, message=message)
+        return None
+
+    def check(self, instance: Any, evt: MaubotMessageEvent) -> float:
+        """
+        Take a token for the given event.
+
+        Returns:
+            0 if the command can be run, otherwise the number of seconds until it can be.
+        """
+        # Plugins are keyed by instance ID so that buckets survive restarts. Other handler
+        # classes have no ID, so they're keyed by object identity to keep their buckets separate.
+        # The object itself isn't used, so that the store doesn't keep it alive.
+        instance_key = getattr(instance, "id", None)
+        if instance_key is None and instance is not None:
+            instance_key = id(instance)
+        key = (
+            instance_key,
+            self.command_id,
+            evt.sender if self.per == "sender" else evt.room_id,
+        )
+        return rate_limit_store.try_take(key, self.rate, self.burst)
+
+
+def _cached_help(func: Callable[["CommandHandler"], str]) -> property:
+    """
+    Cache the result of a help text property until the name of the command, one of its parents
+    or one of its subcommands changes.
+    """
+    key = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self: "CommandHandler") -> str:
+        names = self.__mb_help_names__
+        cache = self.__mb_help_cache__
+        if cache is None or cache[0] != names:
+            cache = self.__mb_help_cache__ = (names, {})
+        try:
+            return cache[1][key]
+        except KeyError:
+            value = cache[1][key] = func(self)
+            return value
+
+    return property(wrapper)
+
+
 class CommandHandler:
     def __init__(self, func: CommandHandlerFunc) -> None:
         self.__mb_func__: CommandHandlerFunc = func
@@ -67,6 +162,7 @@ class CommandHandler:
         self.__mb_arguments__: List[Argument] = []
         self.__mb_help__: Optional[str] = None
         self.__mb_get_name__: Callable[[Any], str] = lambda s: "noname"
+        self.__mb_dynamic_name__: bool = False
         self.__mb_is_command_match__: Callable[[Any, str], bool] = self.__command_match_unset
         self.__mb_require_subcommand__: bool = True
         self.__mb_must_consume_args__: bool = True
@@ -74,14 +170,25 @@ class CommandHandler:
         self.__mb_event_handler__: bool = True
         self.__mb_event_types__: set[EventType] = {EventType.ROOM_MESSAGE}
         self.__mb_msgtypes__: Iterable[MessageType] = (MessageType.TEXT,)
+        self.__mb_rate_limit__: Optional[CommandRateLimit] = None
+        self.__mb_help_cache__: Optional[Tuple[Tuple[str, ...], Dict[str, str]]] = None
+        self.__mb_arg_parser__: Optional[ArgumentParser] = None
         self.__bound_copies__: Dict[Any, CommandHandler] = {}
         self.__bound_instance__: Any = None
 
     def __get__(self, instance, instancetype):
         if not instance or self.__bound_instance__:
             return self
+        # Bound copies are stored in the instance itself, so that they're garbage collected
+        # together with it instead of keeping stopped plugin instances alive forever.
+        try:
+            bound_copies = instance.__dict__.setdefault("__mb_bound_handlers__", {})
+            copy_key = self
+        except AttributeError:
+            bound_copies = self.__bound_copies__
+            copy_key = instance
         try:
-            return self.__bound_copies__[instance]
+            return bound_copies[copy_key]
         except KeyError:
             new_ch = type(self)(self.__mb_func__)
             keys = [
@@ -90,6 +197,7 @@ class CommandHandler:
                 "arguments",
                 "help",
                 "get_name",
+                "dynamic_name",
                 "is_command_match",
                 "require_subcommand",
                 "must_consume_args",
@@ -97,6 +205,7 @@ class CommandHandler:
                 "event_handler",
                 "event_types",
                 "msgtypes",
+                "rate_limit",
             ]
             for key in keys:
                 key = f"__mb_{key}__"
@@ -105,7 +214,7 @@ class CommandHandler:
             new_ch.__mb_subcommands__ = [
                 subcmd.__get__(instance, instancetype) for subcmd in self.__mb_subcommands__
             ]
-            self.__bound_copies__[instance] = new_ch
+            bound_copies[copy_key] = new_ch
             return new_ch
 
     @staticmethod
@@ -150,10 +259,23 @@ class CommandHandler:
             await evt.reply(self.__mb_full_help__)
             return
 
+        if self.__mb_rate_limit__ and not await self.__check_rate_limit__(evt):
+            return
+
         if self.__bound_instance__:
             return await self.__mb_func__(self.__bound_instance__, evt, **call_args)
         return await self.__mb_func__(evt, **call_args)
 
+    async def __check_rate_limit__(self, evt: MaubotMessageEvent) -> bool:
+        retry_after = self.__mb_rate_limit__.check(self.__bound_instance__, evt)
+        if retry_after <= 0:
+            return True
+        if self.__mb_rate_limit__.message:
+            await evt.reply(
+                self.__mb_rate_limit__.message.format(retry_after=math.ceil(retry_after))
+            )
+        return False
+
     async def __call_subcommand__(
         self, evt: MaubotMessageEvent, call_args: Dict[str, Any], remaining_val: str
     ) -> Tuple[bool, Any]:
@@ -168,22 +290,21 @@ class CommandHandler:
     async def __parse_args__(
         self, evt: MaubotMessageEvent, call_args: Dict[str, Any], remaining_val: str
     ) -> Tuple[bool, str]:
-        for arg in self.__mb_arguments__:
-            try:
-                remaining_val, call_args[arg.name] = arg.match(
-                    remaining_val.strip(), evt=evt, instance=self.__bound_instance__
-                )
-                if arg.required and call_args[arg.name] is None:
-                    raise ValueError("Argument required")
-            except ArgumentSyntaxError as e:
-                await evt.reply(e.message + (f"\n{self.__mb_usage__}" if e.show_usage else ""))
-                return False, remaining_val
-            except ValueError:
-                await evt.reply(self.__mb_usage__)
-                return False, remaining_val
-        return True, remaining_val
-
-    @property
+        if not self.__mb_arguments__:
+            return True, remaining_val
+        parser = self.__mb_arg_parser__
+        if parser is None or parser.arguments != self.__mb_arguments__:
+            parser = self.__mb_arg_parser__ = ArgumentParser(self.__mb_arguments__)
+        try:
+            return True, parser.parse(remaining_val, call_args, evt, self.__bound_instance__)
+        except ArgumentSyntaxError as e:
+            await evt.reply(e.message + (f"\n{self.__mb_usage__}" if e.show_usage else ""))
+            return False, remaining_val
+        except ValueError:
+            await evt.reply(self.__mb_usage__)
+            return False, remaining_val
+
+    @_cached_help
     def __mb_full_help__(self) -> str:
         usage = self.__mb_usage_without_subcommands__ + "\n\n"
         if not self.__mb_require_subcommand__:
@@ -191,7 +312,7 @@ class CommandHandler:
         usage += "\n".join(cmd.__mb_usage_inline__ for cmd in self.__mb_subcommands__)
         return usage
 
-    @property
+    @_cached_help
     def __mb_usage_args__(self) -> str:
         arg_usage = " ".join(
             f"<{arg.label}>" if arg.required else f"[{arg.label}]" for arg in self.__mb_arguments__
@@ -209,6 +330,25 @@ class CommandHandler:
         return self.__mb_get_name__(self.__bound_instance__)
 
     @property
+    def __mb_help_names__(self) -> Tuple[str, ...]:
+        # Names that come from callables (e.g. the plugin config) can change at runtime, so they
+        # are checked every time the cached help texts are used.
+        instance = self.__bound_instance__
+        names = []
+        cmd = self
+        while cmd is not None:
+            names.append(cmd.__mb_get_name__(instance) if cmd.__mb_dynamic_name__ else "")
+            cmd = cmd.__mb_parent__
+        return (
+            *names,
+            *(
+                cmd.__mb_get_name__(cmd.__bound_instance__)
+                for cmd in self.__mb_subcommands__
+                if cmd.__mb_dynamic_name__
+            ),
+        )
+
+    @_cached_help
     def __mb_prefix__(self) -> str:
         if self.__mb_parent__:
             return (
@@ -241,7 +381,7 @@ class CommandHandler:
             )
         return f"**Usage:** {self.__mb_prefix__} {self.__mb_usage_args__}"
 
-    @property
+    @_cached_help
     def __mb_usage__(self) -> str:
         if len(self.__mb_subcommands__) > 0:
             return f"{self.__mb_usage_without_subcommands__}  \n{self.__mb_subcommands_list__}"
@@ -255,6 +395,10 @@ class CommandHandler:
         aliases: AliasesType = None,
         required_subcommand: bool = True,
         arg_fallthrough: bool = True,
+        cooldown: float = None,
+        rate: Tuple[int, float] = None,
+        rate_limit_by: str = "sender",
+        rate_limit_message: str = None,
     ) -> CommandHandlerDecorator:
         def decorator(func: Union[CommandHandler, CommandHandlerFunc]) -> CommandHandler:
             if not isinstance(func, CommandHandler):
@@ -265,6 +409,10 @@ class CommandHandler:
                 aliases=aliases,
                 require_subcommand=required_subcommand,
                 arg_fallthrough=arg_fallthrough,
+                cooldown=cooldown,
+                rate=rate,
+                rate_limit_by=rate_limit_by,
+                rate_limit_message=rate_limit_message,
             )(func)
             func.__mb_parent__ = self
             func.__mb_event_handler__ = False
@@ -284,11 +432,31 @@ def new(
     require_subcommand: bool = True,
     arg_fallthrough: bool = True,
     must_consume_args: bool = True,
+    cooldown: float = None,
+    rate: Tuple[int, float] = None,
+    rate_limit_by: str = "sender",
+    rate_limit_message: str = None,
 ) -> CommandHandlerDecorator:
+    """
+    Create a command handler.
+
+    Commands can be rate limited with either ``cooldown`` (the number of seconds between uses)
+    or ``rate`` (a ``(count, seconds)`` tuple allowing bursts of ``count`` uses). The limit is
+    tracked separately for each plugin instance and either each sender or each room, depending
+    on ``rate_limit_by``. Rate limited commands are ignored, unless ``rate_limit_message`` is
+    set, in which case it's sent as a reply. The message may contain ``{retry_after}``, which is
+    replaced with the number of seconds until the command can be used again.
+
+    The limit is only checked once the arguments have been parsed, right before the handler is
+    called, so messages that just get a usage error don't count towards it. For the same reason,
+    the limit of a parent command doesn't apply to its subcommands, which have their own limits.
+    """
+
     def decorator(func: Union[CommandHandler, CommandHandlerFunc]) -> CommandHandler:
         if not isinstance(func, CommandHandler):
             func = CommandHandler(func)
         func.__mb_help__ = help
+        func.__mb_dynamic_name__ = callable(name)
         if name:
             if callable(name):
                 if len(inspect.getfullargspec(name).args) == 0:
@@ -318,6 +486,9 @@ def new(
         func.__mb_event_types__ = {event_type}
         if msgtypes:
             func.__mb_msgtypes__ = msgtypes
+        func.__mb_rate_limit__ = CommandRateLimit.create(
+            func.__mb_func__, cooldown, rate, rate_limit_by, rate_limit_message
+        )
         return func
 
     return decorator
@@ -409,6 +580,100 @@ class SimpleArgument(Argument):
         return val[len(res) :], res
 
 
+_token_regex = re.compile(r"\s*(\S*)")
+
+# Argument kinds for ArgumentParser
+_SIMPLE = 0
+_SIMPLE_RAW = 1
+_REGEX = 2
+_REGEX_RAW = 3
+_CUSTOM = 4
+_OTHER = 5
+
+
+class ArgumentParser:
+    """
+    Matches a list of arguments against the text after a command.
+
+    The built-in argument types are matched by moving an offset through the original text, so
+    the remaining text is only copied for the raw custom arguments and custom argument classes,
+    which need it as a string. The results are the same as calling ``match`` with the stripped
+    remaining text for each argument.
+    """
+
+    arguments: List[Argument]
+    _steps: List[Tuple[int, Argument]]
+
+    def __init__(self, arguments: List[Argument]) -> None:
+        self.arguments = list(arguments)
+        self._steps = [(self._kind(arg), arg) for arg in self.arguments]
+
+    @staticmethod
+    def _kind(arg: Argument) -> int:
+        match = type(arg).match
+        if match is SimpleArgument.match:
+            return _SIMPLE_RAW if arg.pass_raw else _SIMPLE
+        elif match is RegexArgument.match:
+            return _REGEX_RAW if arg.pass_raw else _REGEX
+        elif match is CustomArgument.match and not arg.pass_raw:
+            return _CUSTOM
+        return _OTHER
+
+    def parse(
+        self, text: str, call_args: Dict[str, Any], evt: MaubotMessageEvent, instance: Any
+    ) -> str:
+        """
+        Match all arguments and store the values in ``call_args``.
+
+        Returns:
+            The text that remains after the arguments.
+
+        Raises:
+            ArgumentSyntaxError: if an argument matcher raised it.
+            ValueError: if a required argument is missing or a matcher raised it.
+        """
+        pos = 0
+        end = len(text.rstrip())
+        for kind, arg in self._steps:
+            token_match = _token_regex.match(text, pos, end)
+            start = token_match.start(1)
+            if kind == _SIMPLE:
+                pos = token_match.end(1)
+                value = text[start:pos]
+            elif kind == _SIMPLE_RAW:
+                value = text[start:end]
+                pos = end
+            elif kind == _REGEX:
+                token = text[start : token_match.end(1)]
+                match = arg.regex.match(token)
+                if match:
+                    value = match.groups() or token[: match.end()]
+                    pos = start + match.end()
+                else:
+                    value = None
+                    pos = start
+            elif kind == _REGEX_RAW:
+                val = text[start:end]
+                match = arg.regex.match(val)
+                if match:
+                    value = match.groups() or val[: match.end()]
+                    pos = start + match.end()
+                else:
+                    value = None
+                    pos = start
+            elif kind == _CUSTOM:
+                value = arg.matcher(text[start : token_match.end(1)])
+                pos = token_match.end(1) if value is not None else start
+            else:
+                text, value = arg.match(text[start:end], evt=evt, instance=instance)
+                pos = 0
+                end = len(text.rstrip())
+            call_args[arg.name] = value
+            if arg.required and value is None:
+                raise ValueError("Argument required")
+        return text[pos:end]
+
+
 def argument(
     name: str,
     label: str = None,
@@ -15,7 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Any, AsyncGenerator, cast
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, Iterable, cast
 from collections import defaultdict
 import asyncio
 import inspect
@@ -25,6 +25,7 @@ import os.path
 
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedMap
+from yarl import URL
 
 from mautrix.types import UserID
 from mautrix.util import background_task
@@ -35,8 +36,11 @@ from mautrix.util.logging import TraceLogger
 
 from .client import Client
 from .db import DatabaseEngine, Instance as DBInstance
-from .lib.optionalalchemy import Engine, MetaData, create_engine
-from .lib.plugin_db import ProxyPostgresDatabase
+from .lib.dispatch_limiter import DispatchLimiter, RoomSerializer
+from .lib.legacy_db import LegacyDatabaseExecutor
+from .lib.optionalalchemy import Engine, MetaData, create_engine, inspect_engine
+from .lib.plugin_db import ProxyPostgresDatabase, SharedThreadSQLiteDatabase
+from .lib.sqlite_tuning import profile_init_commands
 from .loader import DatabaseType, PluginLoader, ZippedPluginLoader
 from .plugin_base import Plugin
 
@@ -66,7 +70,9 @@ class PluginInstance(DBInstance):
     base_cfg: RecursiveDict[CommentedMap] | None
     base_cfg_str: str | None
     inst_db: sql.engine.Engine | Database | None
+    inst_db_executor: LegacyDatabaseExecutor | None
     inst_db_tables: dict | None
+    inst_db_tables_version: tuple[str, int] | None
     inst_webapp: PluginWebApp | None
     inst_webapp_url: str | None
     started: bool
@@ -105,7 +111,9 @@ class PluginInstance(DBInstance):
         self.client = None
         self.plugin = None
         self.inst_db = None
+        self.inst_db_executor = None
         self.inst_db_tables = None
+        self.inst_db_tables_version = None
         self.inst_webapp = None
         self.inst_webapp_url = None
         self.base_cfg = None
@@ -130,6 +138,7 @@ class PluginInstance(DBInstance):
     def _introspect_sqlalchemy(self) -> dict:
         metadata = MetaData()
         metadata.reflect(self.inst_db)
+        inspector = inspect_engine(self.inst_db)
         return {
             table.name: {
                 "columns": {
@@ -142,10 +151,46 @@ class PluginInstance(DBInstance):
                     }
                     for column in table.columns
                 },
+                "indexes": [
+                    {
+                        "name": index["name"],
+                        "columns": index["column_names"],
+                        "unique": bool(index["unique"]),
+                    }
+                    for index in inspector.get_indexes(table.name)
+                ],
+                "row_estimate": None,
             }
             for table in metadata.tables.values()
         }
 
+    @staticmethod
+    async def _add_sqlite_row_estimates(
+        tables: dict[str, dict], fetch: Callable[[str], Awaitable[list]]
+    ) -> None:
+        """
+        Estimate the number of rows in SQLite tables without scanning them. The estimates come
+        from ``sqlite_stat1`` if the database has been analyzed, or the largest rowid otherwise.
+        """
+        try:
+            rows = await fetch(
+                "SELECT tbl, MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 GROUP BY tbl"
+            )
+            estimates = {row[0]: row[1] for row in rows}
+        except Exception:
+            estimates = {}
+            for table_name in tables:
+                quoted = table_name.replace('"', '""')
+                try:
+                    rows = await fetch(f'SELECT MAX(rowid) FROM "{quoted}"')
+                except Exception:
+                    # WITHOUT ROWID tables don't have a rowid
+                    continue
+                estimates[table_name] = rows[0][0] or 0
+        for table_name, estimate in estimates.items():
+            if table_name in tables:
+                tables[table_name]["row_estimate"] = estimate
+
     async def _introspect_sqlite(self) -> dict:
         q = """
         SELECT
@@ -162,7 +207,7 @@ class PluginInstance(DBInstance):
         ORDER BY table_name, col_id
         """
         data = await self.inst_db.fetch(q)
-        tables = defaultdict(lambda: {"columns": {}})
+        tables = defaultdict(lambda: {"columns": {}, "indexes": [], "row_estimate": None})
         for column in data:
             table_name = column["table_name"]
             col_name = column["column_name"]
@@ -173,6 +218,20 @@ class PluginInstance(DBInstance):
                 "primary": bool(column["is_primary"]),
                 # TODO uniqueness?
             }
+        q = """
+        SELECT
+            m.name AS table_name,
+            il.name AS index_name,
+            il.[unique] AS is_unique,
+            ii.name AS column_name
+        FROM sqlite_master m
+        JOIN pragma_index_list((m.name)) il
+        JOIN pragma_index_info((il.name)) ii
+        WHERE m.type = 'table'
+        ORDER BY table_name, index_name, ii.seqno
+        """
+        self._add_indexes(tables, await self.inst_db.fetch(q))
+        await self._add_sqlite_row_estimates(tables, self.inst_db.fetch)
         return tables
 
     async def _introspect_postgres(self) -> dict:
@@ -192,7 +251,7 @@ class PluginInstance(DBInstance):
         WHERE col.table_schema=$1
         """
         data = await self.inst_db.fetch(q, self.inst_db.schema_name)
-        tables = defaultdict(lambda: {"columns": {}})
+        tables = defaultdict(lambda: {"columns": {}, "indexes": [], "row_estimate": None})
         for column in data:
             table_name = column["table_name"]
             col_name = column["column_name"]
@@ -210,16 +269,83 @@ class PluginInstance(DBInstance):
                 tables[table_name]["columns"][col_name]["primary"] = True
             elif column["constraint_type"] == "UNIQUE":
                 tables[table_name]["columns"][col_name]["unique"] = True
+        q = """
+        SELECT t.relname AS table_name, i.relname AS index_name, ix.indisunique AS is_unique,
+               a.attname AS column_name
+        FROM pg_index ix
+        JOIN pg_class t ON t.oid=ix.indrelid
+        JOIN pg_class i ON i.oid=ix.indexrelid
+        JOIN pg_namespace n ON n.oid=t.relnamespace
+        CROSS JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k(attnum, ord)
+        LEFT JOIN pg_attribute a ON a.attrelid=t.oid AND a.attnum=k.attnum
+        WHERE n.nspname=$1
+        ORDER BY table_name, index_name, k.ord
+        """
+        self._add_indexes(tables, await self.inst_db.fetch(q, self.inst_db.schema_name))
+        q = """
+        SELECT c.relname AS table_name, c.reltuples::bigint AS estimate
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid=c.relnamespace
+        WHERE n.nspname=$1 AND c.relkind IN ('r', 'p')
+        """
+        for row in await self.inst_db.fetch(q, self.inst_db.schema_name):
+            if row["table_name"] in tables:
+                # reltuples is -1 if the table hasn't been vacuumed or analyzed yet
+                estimate = row["estimate"]
+                tables[row["table_name"]]["row_estimate"] = estimate if estimate >= 0 else None
         return tables
 
+    @staticmethod
+    def _add_indexes(tables: dict[str, dict], data: list) -> None:
+        indexes: dict[tuple[str, str], dict] = {}
+        for row in data:
+            table_name = row["table_name"]
+            if table_name not in tables:
+                continue
+            key = (table_name, row["index_name"])
+            if key not in indexes:
+                indexes[key] = {
+                    "name": row["index_name"],
+                    "columns": [],
+                    "unique": bool(row["is_unique"]),
+                }
+                tables[table_name]["indexes"].append(indexes[key])
+            # Expression indexes don't have a column name
+            if row["column_name"] is not None:
+                indexes[key]["columns"].append(row["column_name"])
+
+    async def _get_db_schema_version(self) -> tuple[str, int] | None:
+        """
+        Get a value that changes when the schema of the instance database changes. SQLite has a
+        built-in schema version counter, while Postgres databases use the version in the
+        upgrade table. ``None`` is returned if the version can't be determined.
+        """
+        if isinstance(self.inst_db, Engine):
+            rows = await self.inst_db_executor.fetch("PRAGMA schema_version")
+            return "sqlalchemy", rows[0][0]
+        elif self.inst_db.scheme == Scheme.SQLITE:
+            return "sqlite", await self.inst_db.fetchval("PRAGMA schema_version")
+        elif self.inst_db.upgrade_table:
+            table = self.inst_db.upgrade_table.version_table_name
+            try:
+                return "postgres", await self.inst_db.fetchval(f"SELECT version FROM {table}")
+            except Exception:
+                return None
+        return None
+
     async def get_db_tables(self) -> dict:
-        if self.inst_db_tables is None:
+        version = await self._get_db_schema_version()
+        if self.inst_db_tables is None or version != self.inst_db_tables_version:
             if isinstance(self.inst_db, Engine):
-                self.inst_db_tables = self._introspect_sqlalchemy()
+                # Reflection is synchronous, so run it in the database thread
+                tables = await self.inst_db_executor.run(self._introspect_sqlalchemy)
+                await self._add_sqlite_row_estimates(tables, self.inst_db_executor.fetch)
             elif self.inst_db.scheme == Scheme.SQLITE:
-                self.inst_db_tables = await self._introspect_sqlite()
+                tables = await self._introspect_sqlite()
             else:
-                self.inst_db_tables = await self._introspect_postgres()
+                tables = await self._introspect_postgres()
+            self.inst_db_tables = tables
+            self.inst_db_tables_version = version
         return self.inst_db_tables
 
     async def load(self) -> bool:
@@ -255,6 +381,49 @@ class PluginInstance(DBInstance):
     def _sqlite_db_path(self) -> str:
         return os.path.join(self.maubot.config["plugin_databases.sqlite"], f"{self.id}.db")
 
+    def _sqlite_init_commands(self) -> list[str]:
+        config = self.maubot.config
+        profile_name = config["plugin_databases.sqlite_instance_profiles"].get(self.id, "default")
+        profiles = config["plugin_databases.sqlite_profiles"]
+        if profile_name not in profiles:
+            self.log.warning(f"SQLite pragma profile {profile_name} not found, using default")
+            profile_name = "default"
+        return profile_init_commands(profiles.get(profile_name) or {})
+
+    def _event_handling_config(self) -> dict[str, Any]:
+        config = self.maubot.config
+        overrides = config["event_handling.instance_overrides"].get(self.id) or {}
+        return {
+            "max_concurrent": config["event_handling.max_concurrent"],
+            "queue_size": config["event_handling.queue_size"],
+            "shed_policy": config["event_handling.shed_policy"],
+            "serialize_rooms": config["event_handling.serialize_rooms"],
+            **overrides,
+        }
+
+    def _create_dispatch_limiter(self) -> DispatchLimiter | RoomSerializer | None:
+        try:
+            config = self._event_handling_config()
+            limiter = DispatchLimiter.from_config(self.id, config)
+            if config["serialize_rooms"]:
+                return RoomSerializer(
+                    self.id,
+                    limiter,
+                    queue_size=config["queue_size"],
+                    shed_policy=config["shed_policy"],
+                )
+            return limiter
+        except (KeyError, TypeError, ValueError) as e:
+            self.log.warning(f"Invalid event handling config, not limiting event handlers: {e}")
+            return None
+
+    @classmethod
+    def sqlite_databases(cls) -> Iterable[tuple[str, Database]]:
+        for instance in cls.cache.values():
+            db = instance.inst_db
+            if instance.started and isinstance(db, Database) and db.scheme == Scheme.SQLITE:
+                yield instance.id, db
+
     async def delete(self) -> None:
         if self.loader is not None:
             self.loader.references.remove(self)
@@ -295,6 +464,7 @@ class PluginInstance(DBInstance):
                     "database interface, which doesn't support postgres."
                 )
             self.inst_db = create_engine(f"sqlite:///{self._sqlite_db_path}")
+            self.inst_db_executor = LegacyDatabaseExecutor(self.inst_db, self.id, self.maubot.loop)
         elif self.loader.meta.database_type == DatabaseType.ASYNCPG:
             if self.database_engine is None:
                 if os.path.exists(self._sqlite_db_path) or not self.maubot.plugin_postgres_db:
@@ -315,10 +485,19 @@ class PluginInstance(DBInstance):
                     upgrade_table=upgrade_table,
                     log=instance_db_log,
                 )
+            elif self.maubot.plugin_sqlite_threads:
+                self.inst_db = SharedThreadSQLiteDatabase(
+                    URL(f"sqlite:{self._sqlite_db_path}"),
+                    thread_pool=self.maubot.plugin_sqlite_threads,
+                    upgrade_table=upgrade_table,
+                    db_args={"init_commands": self._sqlite_init_commands()},
+                    log=instance_db_log,
+                )
             else:
                 self.inst_db = Database.create(
                     f"sqlite:{self._sqlite_db_path}",
                     upgrade_table=upgrade_table,
+                    db_args={"init_commands": self._sqlite_init_commands()},
                     log=instance_db_log,
                 )
             if actually_start:
@@ -330,6 +509,8 @@ class PluginInstance(DBInstance):
         if isinstance(self.inst_db, Database):
             await self.inst_db.stop()
         elif isinstance(self.inst_db, Engine):
+            # The executor stays usable like the disposed engine, e.g. for the database browser
+            await self.inst_db_executor.stop()
             self.inst_db.dispose()
         else:
             raise RuntimeError(f"Unknown database type {type(self.inst_db).__name__}")
@@ -347,6 +528,7 @@ class PluginInstance(DBInstance):
         else:
             raise RuntimeError(f"Unrecognized database type {self.loader.meta.database_type}")
         self.inst_db = None
+        self.inst_db_executor = None
 
     async def start(self) -> None:
         if self.started:
@@ -400,6 +582,8 @@ class PluginInstance(DBInstance):
             log=self.log,
             config=self.config,
             database=self.inst_db,
+            database_executor=self.inst_db_executor,
+            dispatch_limiter=self._create_dispatch_limiter(),
             loader=self.loader,
             webapp=self.inst_webapp,
             webapp_url=self.inst_webapp_url,
@@ -411,7 +595,9 @@ class PluginInstance(DBInstance):
             await self.update_enabled(False)
             return
         self.started = True
-        self.inst_db_tables = None
+        if self.inst_db_tables_version is None:
+            # Without a schema version, the table cache can only be invalidated on restart
+            self.inst_db_tables = None
         self.log.info(
             f"Started instance of {self.loader.meta.id} v{self.loader.meta.version} "
             f"with user {self.client.id}"
@@ -433,7 +619,6 @@ class PluginInstance(DBInstance):
                 await self.stop_database()
             except Exception:
                 self.log.exception("Failed to stop instance database")
-        self.inst_db_tables = None
 
     async def update_id(self, new_id: str | None) -> None:
         if new_id is not None and new_id.lower() != self.id:
@@ -521,6 +706,27 @@ class PluginInstance(DBInstance):
 
         return None
 
+    @classmethod
+    async def load_all(cls) -> list[PluginInstance]:
+        """
+        Load all instances into the cache with a single query and resolve their dependencies.
+        Clients are taken directly from the client cache instead of going through
+        :meth:`Client.get`, so :meth:`Client.load_all` must be called first. Like
+        :meth:`Client.load_all`, this must only be used at startup.
+        """
+        instances = []
+        instance: PluginInstance
+        for instance in await super().all():
+            try:
+                instance = cls.cache[instance.id]
+            except KeyError:
+                instance.postinit()
+            if not instance.client:
+                instance.client = Client.cache.get(instance.primary_user)
+            await instance.load()
+            instances.append(instance)
+        return instances
+
     @classmethod
     async def all(cls) -> AsyncGenerator[PluginInstance, None]:
         instances = await super().all()
@@ -0,0 +1,225 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable
+from html import escape
+import asyncio
+
+from mautrix.types import (
+    EventContent,
+    EventID,
+    EventType,
+    Format,
+    MessageType,
+    RelationType,
+    RoomID,
+    TextMessageEventContent,
+)
+from mautrix.util.opt_prometheus import Counter
+
+from .send_scheduler import SendPriority
+
+COALESCED = Counter(
+    "maubot_send_coalesced",
+    "Number of outgoing messages that were merged into another message instead of being sent",
+    ["kind"],
+)
+
+SendFunc = Callable[[RoomID, EventType, EventContent, "SendPriority | None"], Awaitable[EventID]]
+_PLAIN_NOTICE_FIELDS = {"msgtype", "body", "format", "formatted_body"}
+
+
+class _Pending:
+    __slots__ = ("room_id", "content", "priority", "future", "timer")
+
+    room_id: RoomID
+    content: EventContent
+    priority: SendPriority | None
+    future: asyncio.Future
+    timer: asyncio.TimerHandle | None
+
+    def __init__(
+        self, room_id: RoomID, content: EventContent, priority: SendPriority | None
+    ) -> None:
+        self.room_id = room_id
+        self.content = content
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.timer = None
+
+
+class SendCoalescer:
+    """
+    Reduces the number of events a client sends by holding some messages for a short window:
+
+    * Edits of the same event are throttled to one per ``edit_window``. Only the latest edit in
+      each window is sent.
+    * Plain notices to the same room, except command responses, are merged into one message if
+      they're sent within ``notice_window`` of the first one.
+
+    Everyone whose message was merged gets the ID of the event that was actually sent.
+    """
+
+    send: SendFunc
+    edit_window: float
+    notice_window: float
+    notice_max_length: int
+    _pending: dict[tuple[str, RoomID, EventID | None], _Pending]
+    _tasks: set[asyncio.Task]
+
+    def __init__(
+        self,
+        send: SendFunc,
+        edit_window: float = 0,
+        notice_window: float = 0,
+        notice_max_length: int = 2000,
+    ) -> None:
+        self.send = send
+        self.edit_window = edit_window
+        self.notice_window = notice_window
+        self.notice_max_length = notice_max_length
+        self._pending = {}
+        self._tasks = set()
+
+    @classmethod
+    def from_config(cls, send: SendFunc, config: dict[str, Any]) -> SendCoalescer | None:
+        if config["edit_window"] <= 0 and config["notice_window"] <= 0:
+            return None
+        return cls(
+            send,
+            edit_window=config["edit_window"],
+            notice_window=config["notice_window"],
+            notice_max_length=config["notice_max_length"],
+        )
+
+    @staticmethod
+    def _edit_target(content: EventContent) -> EventID | None:
+        if isinstance(content, dict):
+            relates_to = content.get("m.relates_to") or {}
+            if relates_to.get("rel_type") == RelationType.REPLACE.value:
+                return relates_to.get("event_id")
+            return None
+        get_edit = getattr(content, "get_edit", None)
+        return get_edit() if get_edit else None
+
+    def _is_mergeable_notice(self, content: EventContent, priority: SendPriority | None) -> bool:
+        if priority not in (None, SendPriority.LOW):
+            return False
+        if not isinstance(content, TextMessageEventContent):
+            return False
+        if content.msgtype != MessageType.NOTICE or len(content.body) >= self.notice_max_length:
+            return False
+        return content.serialize().keys() <= _PLAIN_NOTICE_FIELDS
+
+    def _merge_notice(self, pending: _Pending, content: TextMessageEventContent) -> bool:
+        prev: TextMessageEventContent = pending.content
+        if len(prev.body) + len(content.body) + 1 > self.notice_max_length:
+            return False
+        merged = TextMessageEventContent(
+            msgtype=MessageType.NOTICE, body=f"{prev.body}\n{content.body}"
+        )
+        if prev.format == Format.HTML or content.format == Format.HTML:
+            merged.format = Format.HTML
+            merged.formatted_body = "<br>".join(
+                (
+                    part.formatted_body
+                    if part.format == Format.HTML and part.formatted_body
+                    else escape(part.body).replace("\n", "<br>")
+                )
+                for part in (prev, content)
+            )
+        pending.content = merged
+        return True
+
+    async def send_message_event(
+        self,
+        room_id: RoomID,
+        event_type: EventType,
+        content: EventContent,
+        priority: SendPriority | None,
+    ) -> EventID | None:
+        """
+        Send a message through the coalescer.
+
+        Returns:
+            The ID of the event that contains the message, or ``None`` if the message can't be
+            coalesced and should be sent normally.
+        """
+        if event_type != EventType.ROOM_MESSAGE:
+            return None
+        edit_target = self._edit_target(content) if self.edit_window > 0 else None
+        if edit_target:
+            key = ("edit", room_id, edit_target)
+            window = self.edit_window
+        elif self.notice_window > 0 and self._is_mergeable_notice(content, priority):
+            key = ("notice", room_id, None)
+            window = self.notice_window
+        else:
+            return None
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            if edit_target:
+                pending.content = content
+                merged = True
+            else:
+                merged = self._merge_notice(pending, content)
+            if merged:
+                if priority is not None and (
+                    pending.priority is None or priority < pending.priority
+                ):
+                    pending.priority = priority
+                COALESCED.labels(kind=key[0]).inc()
+                return await asyncio.shield(pending.future)
+            # The merged notice would be too long, so send the pending one now
+            self._flush(key)
+
+        pending = self._pending[key] = _Pending(room_id, content, priority)
+        pending.timer = asyncio.get_running_loop().call_later(window, self._flush, key)
+        return await asyncio.shield(pending.future)
+
+    def _flush(self, key: tuple[str, RoomID, EventID | None]) -> None:
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        if pending.timer:
+            pending.timer.cancel()
+        task = asyncio.create_task(self._send(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending: _Pending) -> None:
+        try:
+            event_id = await self.send(
+                pending.room_id, EventType.ROOM_MESSAGE, pending.content, pending.priority
+            )
+        except asyncio.CancelledError:
+            pending.future.cancel()
+            raise
+        except Exception as e:
+            pending.future.set_exception(e)
+            # Don't complain about the exception if all callers were cancelled
+            pending.future.exception()
+        else:
+            pending.future.set_result(event_id)
+
+    async def flush_all(self) -> None:
+        """Send all pending messages immediately and wait for them to be sent."""
+        for key in list(self._pending.keys()):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
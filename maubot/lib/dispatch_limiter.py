@@ -0,0 +1,330 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable
+from collections import deque
+import asyncio
+import logging
+import time
+
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+IN_FLIGHT = Gauge(
+    "maubot_dispatch_in_flight",
+    "Number of event handlers of a plugin instance that are currently running",
+    ["instance"],
+)
+QUEUE_DEPTH = Gauge(
+    "maubot_dispatch_queue_depth",
+    "Number of events waiting for a plugin instance to have a free handler slot",
+    ["instance"],
+)
+ACTIVE_ROOMS = Gauge(
+    "maubot_dispatch_active_rooms",
+    "Number of rooms with pending events for a plugin instance that handles rooms in order",
+    ["instance"],
+)
+ROOM_QUEUE_DEPTH = Gauge(
+    "maubot_dispatch_room_queue_depth",
+    "Number of events waiting for earlier events in the same room to be handled",
+    ["instance"],
+)
+SHED = Counter(
+    "maubot_dispatch_shed",
+    "Number of events that a plugin instance didn't handle because its queue was full",
+    ["instance"],
+)
+
+EventHandler = Callable[[Any], Awaitable[Any]]
+SHED_POLICIES = ("drop_new", "drop_oldest")
+# Minimum number of seconds between warnings about shed events of the same instance
+SHED_LOG_INTERVAL = 60
+
+
+def _check_config(queue_size: Any, shed_policy: Any) -> None:
+    if not isinstance(queue_size, int) or isinstance(queue_size, bool) or queue_size < 0:
+        raise ValueError(f"Invalid queue size {queue_size!r}, must be a non-negative integer")
+    if shed_policy not in SHED_POLICIES:
+        raise ValueError(f"Invalid shed policy {shed_policy!r}")
+
+
+class _ShedLog:
+    """Logs shed events as warnings, at most once per :data:`SHED_LOG_INTERVAL` seconds."""
+
+    def __init__(self, log: logging.Logger) -> None:
+        self.log = log
+        self._last_logged = None
+        self._count = 0
+
+    def shed(self, message: str) -> None:
+        self._count += 1
+        now = time.monotonic()
+        if self._last_logged is None or now - self._last_logged >= SHED_LOG_INTERVAL:
+            self.log.warning(f"{message}, shed {self._count} events since the last warning")
+            self._last_logged = now
+            self._count = 0
+
+
+class DispatchLimiter:
+    """
+    Limits how many event handlers of a single plugin instance can run at the same time.
+
+    Events that arrive while all slots are taken wait in a FIFO queue. When the queue is full,
+    either the incoming event (``drop_new``) or the event that has been waiting the longest
+    (``drop_oldest``) is shed without calling the handler.
+    """
+
+    log: logging.Logger = logging.getLogger("maubot.dispatch_limiter")
+
+    instance_id: str
+    max_concurrent: int
+    queue_size: int
+    shed_policy: str
+    _in_flight: int
+    _waiters: deque[asyncio.Future]
+
+    def __init__(
+        self,
+        instance_id: str,
+        max_concurrent: int,
+        queue_size: int = 0,
+        shed_policy: str = "drop_new",
+    ) -> None:
+        if not isinstance(max_concurrent, int) or isinstance(max_concurrent, bool):
+            raise ValueError(f"Invalid max_concurrent {max_concurrent!r}, must be an integer")
+        elif max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        _check_config(queue_size, shed_policy)
+        self.instance_id = instance_id
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.shed_policy = shed_policy
+        self._in_flight = 0
+        self._waiters = deque()
+        self._in_flight_metric = IN_FLIGHT.labels(instance=instance_id)
+        self._queue_metric = QUEUE_DEPTH.labels(instance=instance_id)
+        self._shed_metric = SHED.labels(instance=instance_id)
+        self._shed_log = _ShedLog(self.log)
+
+    @classmethod
+    def from_config(cls, instance_id: str, config: dict[str, Any]) -> DispatchLimiter | None:
+        max_concurrent = config["max_concurrent"]
+        if isinstance(max_concurrent, int) and max_concurrent <= 0:
+            return None
+        return cls(
+            instance_id,
+            max_concurrent=max_concurrent,
+            queue_size=config["queue_size"],
+            shed_policy=config["shed_policy"],
+        )
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _update_metrics(self) -> None:
+        self._in_flight_metric.set(self._in_flight)
+        self._queue_metric.set(len(self._waiters))
+
+    def _shed(self) -> None:
+        self._shed_metric.inc()
+        self._shed_log.shed(f"Event handler queue of {self.instance_id} is full")
+
+    def _pop_waiter(self) -> asyncio.Future | None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            # Cancelled waiters stay in the queue until their task wakes up
+            if not waiter.done():
+                return waiter
+        return None
+
+    def _release(self) -> None:
+        waiter = self._pop_waiter()
+        if waiter:
+            # Hand the slot directly to the next waiter instead of freeing it, so that new
+            # events can't overtake queued ones
+            waiter.set_result(True)
+        else:
+            self._in_flight -= 1
+        self._update_metrics()
+
+    async def _acquire(self) -> bool:
+        if self._in_flight < self.max_concurrent:
+            self._in_flight += 1
+            self._update_metrics()
+            return True
+        if len(self._waiters) >= self.queue_size:
+            oldest = self._pop_waiter() if self.shed_policy == "drop_oldest" else None
+            self._shed()
+            if oldest is None:
+                return False
+            oldest.set_result(False)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._update_metrics()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                # The slot was already handed to this waiter
+                self._release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+                self._update_metrics()
+            raise
+
+    async def run(self, handler: EventHandler, evt: Any) -> Any:
+        """Call the handler with the event when there's a free slot, unless it's shed."""
+        if not await self._acquire():
+            return None
+        try:
+            return await handler(evt)
+        finally:
+            self._release()
+
+    def wrap(self, handler: EventHandler) -> EventHandler:
+        """Wrap an event handler so that calls to it go through the limiter."""
+
+        async def limited_handler(evt: Any) -> Any:
+            return await self.run(handler, evt)
+
+        return limited_handler
+
+    def stop(self) -> None:
+        """Cancel all queued events. Handlers that are already running aren't affected."""
+        for waiter in self._waiters:
+            waiter.cancel()
+        self._waiters.clear()
+        self._update_metrics()
+
+
+class RoomSerializer:
+    """
+    Runs the event handlers of a single plugin instance one at a time in each room, in the order
+    the events arrived. Different rooms are still handled in parallel.
+
+    Each room with pending events has a worker task that drains the room's queue and exits when
+    the queue is empty, so idle rooms don't use any memory. When a room's queue is full, events
+    are shed according to the shed policy, like in :class:`DispatchLimiter`. If a limiter is
+    given, the workers run the handlers through it.
+    """
+
+    log: logging.Logger = logging.getLogger("maubot.room_serializer")
+
+    instance_id: str
+    limiter: DispatchLimiter | None
+    queue_size: int
+    shed_policy: str
+    _queues: dict[str, deque[tuple[EventHandler, Any]]]
+    _workers: dict[str, asyncio.Task]
+
+    def __init__(
+        self,
+        instance_id: str,
+        limiter: DispatchLimiter | None = None,
+        queue_size: int = 0,
+        shed_policy: str = "drop_new",
+    ) -> None:
+        _check_config(queue_size, shed_policy)
+        self.instance_id = instance_id
+        self.limiter = limiter
+        self.queue_size = queue_size
+        self.shed_policy = shed_policy
+        self._queues = {}
+        self._workers = {}
+        self._rooms_metric = ACTIVE_ROOMS.labels(instance=instance_id)
+        self._queue_metric = ROOM_QUEUE_DEPTH.labels(instance=instance_id)
+        self._shed_metric = SHED.labels(instance=instance_id)
+        self._shed_log = _ShedLog(self.log)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _update_metrics(self) -> None:
+        self._rooms_metric.set(len(self._workers))
+        self._queue_metric.set(self.queue_depth)
+
+    def submit(self, room_id: str, handler: EventHandler, evt: Any) -> None:
+        """Queue an event to be handled after the previous events in the same room."""
+        try:
+            queue = self._queues[room_id]
+        except KeyError:
+            queue = self._queues[room_id] = deque()
+            self._workers[room_id] = asyncio.create_task(self._work(room_id, queue))
+        else:
+            if len(queue) >= self.queue_size:
+                self._shed_metric.inc()
+                self._shed_log.shed(f"Room queue of {self.instance_id} is full")
+                if self.shed_policy == "drop_new" or not queue:
+                    return
+                queue.popleft()
+        queue.append((handler, evt))
+        self._update_metrics()
+
+    async def _run(self, handler: EventHandler, evt: Any) -> Any:
+        if self.limiter:
+            return await self.limiter.run(handler, evt)
+        return await handler(evt)
+
+    async def _work(self, room_id: str, queue: deque[tuple[EventHandler, Any]]) -> None:
+        try:
+            while queue:
+                handler, evt = queue.popleft()
+                self._update_metrics()
+                try:
+                    await self._run(handler, evt)
+                except Exception:
+                    self.log.exception(f"Failed to run handler of {self.instance_id}")
+        finally:
+            # There's no await between the loop condition and this, so nothing can be added to
+            # the queue after the worker decided to exit
+            if self._queues.get(room_id) is queue:
+                del self._queues[room_id]
+                del self._workers[room_id]
+            self._update_metrics()
+
+    def wrap(self, handler: EventHandler) -> EventHandler:
+        """
+        Wrap an event handler so that events with a room ID are queued in the room. The wrapped
+        handler returns as soon as the event is queued.
+        """
+
+        async def serialized_handler(evt: Any) -> Any:
+            room_id = getattr(evt, "room_id", None)
+            if room_id is None:
+                return await self._run(handler, evt)
+            self.submit(room_id, handler, evt)
+
+        return serialized_handler
+
+    def stop(self) -> None:
+        """Drop all queued events. Handlers that are already running aren't affected."""
+        for queue in self._queues.values():
+            queue.clear()
+        self._queues.clear()
+        self._workers.clear()
+        if self.limiter:
+            self.limiter.stop()
+        self._update_metrics()
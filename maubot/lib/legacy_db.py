@@ -0,0 +1,112 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Callable, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import threading
+import time
+
+from mautrix.util.opt_prometheus import Histogram
+
+from .optionalalchemy import Engine, event
+
+T = TypeVar("T")
+
+LEGACY_DB_TIME = Histogram(
+    "maubot_legacy_db_seconds",
+    "Time spent executing queries in legacy SQLAlchemy plugin databases",
+    ["instance", "thread"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+class LegacyDatabaseExecutor:
+    """
+    Runs calls to a synchronous SQLAlchemy engine in a dedicated thread, so that they don't
+    block the event loop. The executor has a single thread, which also keeps SQLite
+    connections on the thread that created them.
+
+    The time spent in each query is recorded in the ``maubot_legacy_db_seconds`` metric,
+    labeled with whether the query ran on the event loop thread (i.e. blocked all bots) or in
+    the executor.
+    """
+
+    engine: Engine
+    instance_id: str
+    _executor: ThreadPoolExecutor | None
+    _loop: asyncio.AbstractEventLoop
+    _loop_thread_id: int
+
+    def __init__(self, engine: Engine, instance_id: str, loop: asyncio.AbstractEventLoop) -> None:
+        self.engine = engine
+        self.instance_id = instance_id
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._executor = None
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, many) -> None:
+        conn.info.setdefault("maubot_query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, many) -> None:
+        duration = time.perf_counter() - conn.info["maubot_query_start"].pop()
+        thread = "loop" if threading.get_ident() == self._loop_thread_id else "executor"
+        LEGACY_DB_TIME.labels(instance=self.instance_id, thread=thread).observe(duration)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run a function in the database thread."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"maubot-legacy-db-{self.instance_id}"
+            )
+        return await self._loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def fetch(self, query: Any, *args: Any, **kwargs: Any) -> list:
+        """Execute a query in the database thread and fetch all the rows it returns."""
+
+        def fetch() -> list:
+            return self.engine.execute(query, *args, **kwargs).fetchall()
+
+        return await self.run(fetch)
+
+    async def execute(self, query: Any, *args: Any, **kwargs: Any) -> Any:
+        """
+        Execute a query in the database thread. If the query returns rows, they're fetched
+        before returning, so the result can be used on the event loop without blocking it.
+        """
+
+        def execute() -> Any:
+            res = self.engine.execute(query, *args, **kwargs)
+            if res.returns_rows:
+                return res.fetchall()
+            return res
+
+        return await self.run(execute)
+
+    async def stop(self) -> None:
+        """
+        Wait for queued calls to finish and stop the database thread. Like a disposed engine,
+        the executor can still be used after stopping, which starts a new thread.
+        """
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            await self._loop.run_in_executor(None, executor.shutdown)
@@ -0,0 +1,178 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from types import FrameType
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
+
+from ..loader import ZippedPluginLoader
+
+LOOP_LAG = Histogram(
+    "maubot_event_loop_lag_seconds",
+    "How late the event loop woke up from a sleep",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+LOOP_MAX_LAG = Gauge("maubot_event_loop_max_lag_seconds", "Maximum observed event loop lag")
+LOOP_BLOCKS = Counter(
+    "maubot_event_loop_blocks", "Number of times the event loop was blocked", ["plugin"]
+)
+LOOP_BLOCKED_TIME = Counter(
+    "maubot_event_loop_blocked_seconds", "Time the event loop spent blocked", ["plugin"]
+)
+
+
+def find_plugin(frame: FrameType | None) -> str | None:
+    """
+    Find the innermost plugin in a stack by checking which plugin archive each frame's code is
+    from. If the stack doesn't go through any plugin code, ``None`` is returned.
+    """
+    while frame is not None:
+        loader = ZippedPluginLoader.find_by_file(frame.f_code.co_filename)
+        if loader is not None and loader.meta is not None:
+            return loader.meta.id
+        frame = frame.f_back
+    return None
+
+
+class LoopMonitor:
+    """
+    A watchdog that measures event loop lag and detects blocking calls.
+
+    The lag is measured by a task on the event loop that sleeps for a fixed interval and checks
+    how late it woke up. Because that task can't run while the loop is blocked, a separate thread
+    checks when the task last ran, and if it's been longer than the threshold, samples the stack
+    of the event loop thread to find out what is blocking it.
+    """
+
+    log: logging.Logger = logging.getLogger("maubot.loop_monitor")
+    loop: asyncio.AbstractEventLoop
+    interval: float
+    threshold: float
+
+    lag: float
+    max_lag: float
+    blocks: int
+    _last_tick: float
+    _loop_thread_id: int | None
+    _pending_block: tuple[str | None, list[str]] | None
+    _pending_block_lock: threading.Lock
+    _task: asyncio.Task | None
+    _thread: threading.Thread | None
+    _stop_event: threading.Event
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, threshold: float) -> None:
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0
+        self.max_lag = 0
+        self.blocks = 0
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._pending_block = None
+        self._pending_block_lock = threading.Lock()
+        self._task = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stop_event.clear()
+        self._task = self.loop.create_task(self._measure_loop())
+        self._thread = threading.Thread(
+            target=self._watch_loop, name="maubot-loop-monitor", daemon=True
+        )
+        self._thread.start()
+        self.log.debug(
+            f"Started event loop monitor (interval: {self.interval}s, "
+            f"threshold: {self.threshold}s)"
+        )
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._thread:
+            self._thread.join(timeout=self.interval * 2)
+            self._thread = None
+
+    async def _measure_loop(self) -> None:
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            self._last_tick = time.monotonic()
+            lag = max(self.loop.time() - start - self.interval, 0)
+            self.lag = lag
+            LOOP_LAG.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+                LOOP_MAX_LAG.set(lag)
+            if lag >= self.threshold:
+                self._report_block(lag)
+            else:
+                with self._pending_block_lock:
+                    self._pending_block = None
+
+    def _report_block(self, duration: float) -> None:
+        # The pending block is written by the watchdog thread
+        with self._pending_block_lock:
+            pending, self._pending_block = self._pending_block, None
+        plugin_id, stack = pending or (None, [])
+        self.blocks += 1
+        label = plugin_id or "unknown"
+        LOOP_BLOCKS.labels(plugin=label).inc()
+        LOOP_BLOCKED_TIME.labels(plugin=label).inc(duration)
+        culprit = f"plugin {plugin_id}" if plugin_id else "non-plugin code"
+        if stack:
+            self.log.warning(
+                f"Event loop was blocked for {duration:.3f}s by {culprit}, "
+                f"stack when blocked:\n{''.join(stack).rstrip()}"
+            )
+        else:
+            self.log.warning(f"Event loop was blocked for {duration:.3f}s")
+
+    def _watch_loop(self) -> None:
+        while not self._stop_event.wait(self.interval / 2):
+            blocked_for = time.monotonic() - self._last_tick - self.interval
+            if blocked_for < self.threshold:
+                continue
+            with self._pending_block_lock:
+                if self._pending_block is not None:
+                    # Only sample the stack once per block
+                    continue
+            try:
+                sample = self._sample_stack()
+            except Exception:
+                self.log.exception("Failed to sample event loop stack")
+                sample = (None, [])
+            with self._pending_block_lock:
+                if self._pending_block is None:
+                    self._pending_block = sample
+
+    def _sample_stack(self) -> tuple[str | None, list[str]]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None, []
+        return find_plugin(frame), traceback.format_stack(frame)
@@ -1,5 +1,13 @@
 try:
-    from sqlalchemy import MetaData, asc, create_engine, desc
+    from sqlalchemy import (
+        MetaData,
+        asc,
+        create_engine,
+        desc,
+        event,
+        inspect as inspect_engine,
+        text,
+    )
     from sqlalchemy.engine import Engine
     from sqlalchemy.exc import IntegrityError, OperationalError
 except ImportError:
@@ -14,6 +22,10 @@ except ImportError:
     def create_engine(*args, **kwargs):
         raise Exception("SQLAlchemy is not installed")
 
+    def inspect_engine(*args, **kwargs):
+        raise Exception("SQLAlchemy is not installed")
+
     MetaData = Engine = FakeType
     IntegrityError = OperationalError = FakeError
-    asc = desc = lambda a: a
+    asc = desc = text = lambda a: a
+    event = None
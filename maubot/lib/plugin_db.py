@@ -15,10 +15,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
+from typing import Any, Callable
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 import asyncio
+import functools
+import os
+import sqlite3
+import zlib
+
+from yarl import URL
 
 from mautrix.util.async_db import Database, PostgresDatabase, Scheme, UpgradeTable
+from mautrix.util.async_db.aiosqlite import SQLiteDatabase, TxnConnection
 from mautrix.util.async_db.connection import LoggingConnection
 from mautrix.util.logging import TraceLogger
 
@@ -97,4 +106,139 @@ class ProxyPostgresDatabase(Database):
                     self.log.debug("Connection was closed after use, not resetting search_path")
 
 
-__all__ = ["ProxyPostgresDatabase"]
+class SQLiteThreadPool:
+    """
+    A fixed set of threads that SQLite plugin database connections are spread over, instead of
+    every connection having its own thread. Each connection is pinned to one thread based on the
+    database path, so the sqlite3 connection is only ever used from the thread that created it.
+
+    While a connection waits for a lock held by another process, the thread can't run anything
+    else, so every database sharing it is blocked too. To bound that, connections in the pool
+    have their busy timeout capped to ``max_busy_timeout`` milliseconds.
+    """
+
+    _executors: list[ThreadPoolExecutor]
+    max_busy_timeout: int
+
+    def __init__(self, size: int, max_busy_timeout: int = 1000) -> None:
+        self.max_busy_timeout = max_busy_timeout
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"maubot-sqlite-{i}")
+            for i in range(size)
+        ]
+
+    def executor_for(self, path: str) -> ThreadPoolExecutor:
+        return self._executors[zlib.crc32(path.encode("utf-8")) % len(self._executors)]
+
+    def stop(self) -> None:
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+
+
+class SharedThreadConnection(TxnConnection):
+    """
+    An aiosqlite connection that runs its calls in a :class:`SQLiteThreadPool` thread
+    instead of starting a dedicated thread.
+
+    aiosqlite has no public way to do this, so this overrides its private ``__await__``,
+    ``_connect``, ``_execute`` and ``stop`` methods and relies on the ``_connection`` and
+    ``_connector`` attributes. The ``_thread`` that ``aiosqlite.Connection.__init__`` creates is
+    never started. This was written against aiosqlite 0.22, and requirements.txt pins the
+    version to that release series, so check these internals before raising the upper bound.
+    """
+
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, path: str, executor: ThreadPoolExecutor, **kwargs) -> None:
+        super().__init__(path, **kwargs)
+        self._executor = executor
+
+    def __await__(self):
+        return self._connect().__await__()
+
+    async def _connect(self) -> SharedThreadConnection:
+        if self._connection is None:
+            loop = asyncio.get_running_loop()
+            self._connection = await loop.run_in_executor(self._executor, self._connector)
+        return self
+
+    async def _execute(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        if not self._connection:
+            raise ValueError("Connection closed")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def stop(self) -> None:
+        # There's no dedicated thread to stop
+        pass
+
+    async def close(self) -> None:
+        if self._connection is None:
+            return
+        try:
+            await self._execute(self._connection.close)
+        finally:
+            self._connection = None
+
+
+class SharedThreadSQLiteDatabase(SQLiteDatabase):
+    """
+    A SQLite database whose connections run in a shared :class:`SQLiteThreadPool`.
+    Each instance still has its own database file, so instances stay isolated.
+    """
+
+    _thread_pool: SQLiteThreadPool
+
+    def __init__(
+        self,
+        url: URL,
+        thread_pool: SQLiteThreadPool,
+        upgrade_table: UpgradeTable | None,
+        db_args: dict[str, Any] | None = None,
+        log: TraceLogger | None = None,
+    ) -> None:
+        super().__init__(
+            url, upgrade_table=upgrade_table or UpgradeTable(), db_args=db_args, log=log
+        )
+        self._thread_pool = thread_pool
+
+    async def start(self) -> None:
+        if self._conns:
+            raise RuntimeError("database pool has already been started")
+        elif self._stopped:
+            raise RuntimeError("database pool can't be restarted")
+        self.log.debug(f"Connecting to {self.url} in shared thread pool")
+        executor = self._thread_pool.executor_for(os.path.abspath(self._path))
+        for _ in range(self._pool.maxsize):
+            conn = await SharedThreadConnection(self._path, executor, **self._db_args)
+            if self._init_commands:
+                cur = await conn.cursor()
+                for command in self._init_commands:
+                    self.log.trace("Executing init command: %s", command)
+                    await cur.execute(command)
+                await conn.commit()
+            await self._cap_busy_timeout(conn)
+            conn.row_factory = sqlite3.Row
+            self._pool.put_nowait(conn)
+            self._conns += 1
+        await Database.start(self)
+
+    async def _cap_busy_timeout(self, conn: SharedThreadConnection) -> None:
+        max_timeout = self._thread_pool.max_busy_timeout
+        cur = await conn.execute("PRAGMA busy_timeout")
+        (busy_timeout,) = await cur.fetchone()
+        await cur.close()
+        if busy_timeout > max_timeout:
+            self.log.debug(
+                f"Lowering busy timeout from {busy_timeout} to {max_timeout} ms, "
+                "because the connection runs in a shared thread"
+            )
+            await conn.execute(f"PRAGMA busy_timeout = {max_timeout:d}")
+
+
+__all__ = [
+    "ProxyPostgresDatabase",
+    "SQLiteThreadPool",
+    "SharedThreadConnection",
+    "SharedThreadSQLiteDatabase",
+]
@@ -0,0 +1,138 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from collections import Counter
+from types import FrameType
+import asyncio
+import sys
+import threading
+import time
+
+from ..loader import PluginLoader, ZippedPluginLoader
+
+
+class SamplingProfiler:
+    """
+    A sampling profiler that periodically captures the stacks of running threads from a
+    background thread and aggregates them into the collapsed stack format used by flamegraph
+    tools (``frame;frame;frame count``, one stack per line, outermost frame first).
+
+    Frames that are in plugin archives are labeled with the plugin ID instead of the archive
+    path, and each stack is prefixed with the ID of the innermost plugin in it (or ``maubot``
+    if the stack doesn't go through plugin code).
+    """
+
+    duration: float
+    interval: float
+    thread_ids: set[int] | None
+    only_loader: PluginLoader | None
+    samples: Counter[str]
+    sample_count: int
+    _labels: dict[tuple[str, str, int], tuple[str, str | None]]
+
+    def __init__(
+        self,
+        duration: float,
+        rate: float,
+        thread_ids: set[int] | None = None,
+        only_loader: PluginLoader | None = None,
+    ) -> None:
+        """
+        Args:
+            duration: How long to sample for, in seconds.
+            rate: How many samples to take per second.
+            thread_ids: The threads to sample. If ``None``, all threads except the profiler
+                itself are sampled.
+            only_loader: If set, only stacks that go through the given plugin's modules are
+                included in the output.
+        """
+        self.duration = duration
+        self.interval = 1 / rate
+        self.thread_ids = thread_ids
+        self.only_loader = only_loader
+        self.samples = Counter()
+        self.sample_count = 0
+        self._labels = {}
+
+    def _label(self, frame: FrameType) -> tuple[str, str | None]:
+        code = frame.f_code
+        key = (code.co_filename, code.co_name, code.co_firstlineno)
+        try:
+            return self._labels[key]
+        except KeyError:
+            pass
+        loader = ZippedPluginLoader.find_by_file(code.co_filename)
+        if loader is not None and loader.meta is not None:
+            file = f"{loader.meta.id}:{code.co_filename[len(loader.path):].lstrip('/')}"
+            plugin_id = loader.meta.id
+        else:
+            file = code.co_filename
+            plugin_id = None
+        label = (f"{code.co_name} ({file}:{code.co_firstlineno})", plugin_id)
+        self._labels[key] = label
+        return label
+
+    def _collapse(self, frame: FrameType | None) -> str | None:
+        labels = []
+        innermost_plugin = None
+        while frame is not None:
+            label, plugin_id = self._label(frame)
+            labels.append(label)
+            if plugin_id and not innermost_plugin:
+                innermost_plugin = plugin_id
+            frame = frame.f_back
+        if self.only_loader and innermost_plugin != self.only_loader.meta.id:
+            return None
+        labels.append(innermost_plugin or "maubot")
+        return ";".join(reversed(labels))
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id or (self.thread_ids and thread_id not in self.thread_ids):
+                continue
+            stack = self._collapse(frame)
+            if stack:
+                self.samples[stack] += 1
+        self.sample_count += 1
+
+    def run(self) -> None:
+        end = time.monotonic() + self.duration
+        next_sample = time.monotonic()
+        while next_sample < end:
+            self._sample()
+            next_sample += self.interval
+            time.sleep(max(next_sample - time.monotonic(), 0))
+
+    async def run_async(self) -> None:
+        """Run the profiler in a new background thread and wait for it to finish."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def run() -> None:
+            try:
+                self.run()
+            except Exception as e:
+                loop.call_soon_threadsafe(fut.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(fut.set_result, None)
+
+        threading.Thread(target=run, name="maubot-profiler", daemon=True).start()
+        await fut
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
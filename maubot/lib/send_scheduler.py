@@ -0,0 +1,334 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, TypeVar
+from collections import deque
+from enum import IntEnum
+from json.decoder import JSONDecodeError
+import asyncio
+import logging
+import time
+
+from aiohttp import ClientResponse
+from aiohttp.client_exceptions import ContentTypeError
+from yarl import URL
+
+from mautrix.api import HTTPAPI, Method
+from mautrix.errors import MLimitExceeded, make_request_error
+from mautrix.types import JSON, RoomID
+from mautrix.util.async_body import AsyncBody
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+from .token_bucket import TokenBucket
+
+T = TypeVar("T")
+
+QUEUE_DEPTH = Gauge(
+    "maubot_send_queue_depth",
+    "Number of outgoing messages waiting for a rate limit token",
+    ["client", "priority"],
+)
+RATE_LIMITED = Counter(
+    "maubot_send_rate_limited",
+    "Number of outgoing messages rejected by the homeserver with M_LIMIT_EXCEEDED",
+    ["client"],
+)
+
+
+class SendPriority(IntEnum):
+    """Priority lanes of the send scheduler. Lower values are sent first."""
+
+    #: Direct responses to commands and other user actions.
+    HIGH = 0
+    #: Messages that don't specify a priority and aren't notices.
+    NORMAL = 1
+    #: Notices sent without being asked to, like feed updates.
+    LOW = 2
+
+
+class _Waiter:
+    __slots__ = ("room_id", "future")
+
+    def __init__(self, room_id: RoomID) -> None:
+        self.room_id = room_id
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class SendScheduler:
+    """
+    Schedules the outgoing messages of a single client with token buckets for each room and for
+    the whole client. Messages are sent in priority order, and in FIFO order within each room and
+    priority. If the homeserver responds with ``M_LIMIT_EXCEEDED``, all sending is paused for the
+    ``retry_after_ms`` it specified and the message is retried.
+    """
+
+    log: logging.Logger = logging.getLogger("maubot.send_scheduler")
+    # Room buckets are pruned when there are more than this many and they're full
+    max_idle_rooms: int = 1000
+
+    client_id: str
+    room_rate: float
+    room_burst: float
+    max_retries: int
+    default_retry_after: float
+    _global: TokenBucket
+    _rooms: dict[RoomID, TokenBucket]
+    _lanes: dict[SendPriority, deque[_Waiter]]
+    _paused_until: float
+    _wakeup: asyncio.Event | None
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        client_id: str,
+        room_rate: float = 1,
+        room_burst: float = 5,
+        global_rate: float = 5,
+        global_burst: float = 20,
+        max_retries: int = 3,
+        default_retry_after: float = 5,
+    ) -> None:
+        self.client_id = client_id
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.default_retry_after = default_retry_after
+        self._global = TokenBucket(global_rate, global_burst)
+        self._rooms = {}
+        self._lanes = {priority: deque() for priority in SendPriority}
+        self._paused_until = 0
+        self._wakeup = None
+        self._task = None
+
+    @classmethod
+    def from_config(cls, client_id: str, config: dict[str, Any]) -> SendScheduler:
+        return cls(
+            client_id,
+            room_rate=config["room_rate"],
+            room_burst=config["room_burst"],
+            global_rate=config["global_rate"],
+            global_burst=config["global_burst"],
+            max_retries=config["max_retries"],
+        )
+
+    def queue_depth(self, priority: SendPriority | None = None) -> int:
+        if priority is not None:
+            return len(self._lanes[priority])
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for lane in self._lanes.values():
+            for waiter in lane:
+                waiter.future.cancel()
+            lane.clear()
+        self._update_metrics()
+
+    def _update_metrics(self) -> None:
+        for priority, lane in self._lanes.items():
+            QUEUE_DEPTH.labels(client=self.client_id, priority=priority.name.lower()).set(
+                len(lane)
+            )
+
+    async def _acquire(self, room_id: RoomID, priority: SendPriority, retry: bool) -> None:
+        waiter = _Waiter(room_id)
+        lane = self._lanes[priority]
+        if retry:
+            # Retries go first so that messages in a room aren't reordered
+            lane.appendleft(waiter)
+        else:
+            lane.append(waiter)
+        self._update_metrics()
+        if not self._task:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+        self._wakeup.set()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            try:
+                lane.remove(waiter)
+            except ValueError:
+                pass
+            self._update_metrics()
+            raise
+
+    def _pick(self, now: float) -> float:
+        """
+        Release the first waiter that can be sent now.
+
+        Returns:
+            0 if a waiter was released, otherwise the number of seconds until one can be.
+        """
+        min_delay = float("inf")
+        for lane in self._lanes.values():
+            blocked_rooms = set()
+            for waiter in lane:
+                if waiter.future.done():
+                    # The caller was cancelled, but its task hasn't removed the waiter yet
+                    lane.remove(waiter)
+                    return 0
+                if waiter.room_id in blocked_rooms:
+                    continue
+                try:
+                    bucket = self._rooms[waiter.room_id]
+                except KeyError:
+                    bucket = self._rooms[waiter.room_id] = TokenBucket(
+                        self.room_rate, self.room_burst
+                    )
+                delay = bucket.delay(now)
+                if delay > 0:
+                    blocked_rooms.add(waiter.room_id)
+                    min_delay = min(min_delay, delay)
+                    continue
+                lane.remove(waiter)
+                bucket.take()
+                self._global.take()
+                waiter.future.set_result(None)
+                return 0
+        return min_delay
+
+    def _prune_rooms(self, now: float) -> None:
+        if len(self._rooms) > self.max_idle_rooms:
+            for room_id, bucket in list(self._rooms.items()):
+                if bucket.is_full(now):
+                    del self._rooms[room_id]
+
+    async def _sleep(self, delay: float) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _loop(self) -> None:
+        try:
+            while True:
+                self._update_metrics()
+                if not self.queue_depth():
+                    self._prune_rooms(time.monotonic())
+                    await self._sleep(None)
+                    continue
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                delay = self._global.delay(now)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                delay = self._pick(now)
+                if delay > 0:
+                    await self._sleep(delay)
+        except Exception as e:
+            self.log.exception(f"Send scheduler of {self.client_id} crashed")
+            # Fail the queued messages instead of leaving them waiting for a loop that's gone
+            for lane in self._lanes.values():
+                for waiter in lane:
+                    if not waiter.future.done():
+                        waiter.future.set_exception(e)
+                lane.clear()
+            self._update_metrics()
+        finally:
+            # Let the next message start a new loop, unless stop() already replaced the task
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    def pause(self, seconds: float) -> None:
+        """Stop sending any messages for the given number of seconds."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def send(
+        self, room_id: RoomID, priority: SendPriority, func: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        Call ``func`` once the rate limits allow sending a message to the given room.
+
+        Raises:
+            MLimitExceeded: if the homeserver rate limited the message more than
+                ``max_retries`` times.
+        """
+        retry = False
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(room_id, priority, retry=retry)
+            try:
+                return await func()
+            except MLimitExceeded as e:
+                RATE_LIMITED.labels(client=self.client_id).inc()
+                retry_after_ms = getattr(e, "retry_after_ms", None)
+                retry_after = retry_after_ms / 1000 if retry_after_ms else self.default_retry_after
+                if attempt >= self.max_retries:
+                    raise
+                self.log.warning(
+                    f"{self.client_id} was rate limited while sending to {room_id}, "
+                    f"pausing sending for {retry_after} seconds"
+                )
+                self.pause(retry_after)
+                retry = True
+
+
+class RateLimitAwareHTTPAPI(HTTPAPI):
+    """
+    An HTTPAPI that stores the ``retry_after_ms`` field of ``M_LIMIT_EXCEEDED`` errors as the
+    ``retry_after_ms`` attribute of the :class:`MLimitExceeded` exception.
+
+    mautrix doesn't expose the error response body, so this overrides the private
+    ``HTTPAPI._send`` with a copy of it from mautrix 0.21. requirements.txt pins mautrix to that
+    release series, so compare this with the new ``HTTPAPI._send`` before raising the pin.
+    """
+
+    async def _send(
+        self,
+        method: Method,
+        url: URL,
+        content: bytes | bytearray | str | AsyncBody,
+        query_params: dict[str, str],
+        headers: dict[str, str],
+    ) -> tuple[JSON, ClientResponse]:
+        # This is the same as HTTPAPI._send in mautrix 0.21, except for the handling of
+        # retry_after_ms
+        request = self.session.request(
+            str(method), url, data=content, params=query_params, headers=headers
+        )
+        async with request as response:
+            if response.status < 200 or response.status >= 300:
+                errcode = unstable_errcode = message = None
+                retry_after_ms = None
+                try:
+                    response_data = await response.json()
+                    retry_after_ms = response_data.get("retry_after_ms")
+                    errcode = response_data["errcode"]
+                    message = response_data["error"]
+                    unstable_errcode = response_data.get("org.matrix.msc3848.unstable.errcode")
+                except (JSONDecodeError, ContentTypeError, KeyError, AttributeError):
+                    pass
+                err = make_request_error(
+                    http_status=response.status,
+                    text=await response.text(),
+                    errcode=errcode,
+                    message=message,
+                    unstable_errcode=unstable_errcode,
+                )
+                if isinstance(err, MLimitExceeded):
+                    retry_after_header = response.headers.get("Retry-After", "")
+                    if retry_after_ms is None and retry_after_header.isdigit():
+                        retry_after_ms = int(retry_after_header) * 1000
+                    err.retry_after_ms = retry_after_ms
+                raise err
+            return await response.json(), response
@@ -0,0 +1,103 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Callable, Iterable
+import asyncio
+import logging
+import re
+
+from mautrix.util.async_db import Database
+
+ALLOWED_PRAGMAS = {
+    "journal_mode",
+    "synchronous",
+    "mmap_size",
+    "cache_size",
+    "busy_timeout",
+    "temp_store",
+    "wal_autocheckpoint",
+    "foreign_keys",
+}
+pragma_value_regex = re.compile(r"^(-?[0-9]+|[A-Za-z]+)$")
+
+
+def profile_init_commands(profile: dict[str, Any]) -> list[str]:
+    """
+    Convert a pragma profile from the config into connection init commands.
+
+    Raises:
+        ValueError: if the profile contains an unknown pragma or an invalid value.
+    """
+    commands = []
+    for name, value in profile.items():
+        if name not in ALLOWED_PRAGMAS:
+            raise ValueError(f"Unsupported SQLite pragma {name}")
+        if isinstance(value, bool):
+            value = "ON" if value else "OFF"
+        value = str(value)
+        if not pragma_value_regex.match(value):
+            raise ValueError(f"Invalid value {value!r} for SQLite pragma {name}")
+        commands.append(f"PRAGMA {name} = {value}")
+    return commands
+
+
+class SQLiteMaintenance:
+    """
+    Periodically checkpoints the write-ahead log and runs ``PRAGMA optimize`` in SQLite plugin
+    databases. Databases are processed one by one to avoid an I/O spike when there are many.
+    """
+
+    log: logging.Logger = logging.getLogger("maubot.sqlite_maintenance")
+    interval: float
+    get_databases: Callable[[], Iterable[tuple[str, Database]]]
+    _task: asyncio.Task | None
+
+    def __init__(
+        self, interval: float, get_databases: Callable[[], Iterable[tuple[str, Database]]]
+    ) -> None:
+        self.interval = interval
+        self.get_databases = get_databases
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._loop())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                self.log.exception("Error in SQLite maintenance")
+
+    async def run_once(self) -> None:
+        count = 0
+        for name, db in list(self.get_databases()):
+            try:
+                async with db.acquire() as conn:
+                    await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                    await conn.execute("PRAGMA optimize")
+            except Exception as e:
+                self.log.warning(f"Failed to run maintenance for {name}: {e}")
+            else:
+                count += 1
+        self.log.debug(f"Ran maintenance for {count} SQLite databases")
@@ -13,15 +13,584 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Iterable, TypeVar
+from collections import OrderedDict, defaultdict
+import asyncio
+import json
+
 from mautrix.client.state_store.asyncpg import PgStateStore as BasePgStateStore
+from mautrix.types import (
+    EventID,
+    EventType,
+    Member,
+    Membership,
+    MemberStateEventContent,
+    PowerLevelStateEventContent,
+    RoomEncryptionStateEventContent,
+    RoomID,
+    StateEvent,
+    UserID,
+)
+from mautrix.util.async_db import Connection, Database, Scheme
+from mautrix.util.opt_prometheus import Counter, Gauge
 
 try:
     from mautrix.crypto import StateStore as CryptoStateStore
 
-    class PgStateStore(BasePgStateStore, CryptoStateStore):
+    class _BaseStateStore(BasePgStateStore, CryptoStateStore):
         pass
 
 except ImportError as e:
-    PgStateStore = BasePgStateStore
+    _BaseStateStore = BasePgStateStore
+
+T = TypeVar("T")
+
+CACHE_LOOKUPS = Counter(
+    "maubot_state_cache_lookups",
+    "Number of state store lookups served from the in-memory cache (hit) or the database (miss)",
+    ["kind", "result"],
+)
+CACHED_ROOMS = Gauge("maubot_state_cache_rooms", "Number of rooms in the state store cache")
+STATE_BATCH_EVENTS = Counter(
+    "maubot_state_batch_events", "Number of state events persisted in sync batches", ["type"]
+)
+
+# Marks a value that hasn't been fetched from the database yet (None is a valid cached value)
+_MISSING = object()
+
+
+# Postgres member upserts with at least this many rows go through COPY into a temporary table
+COPY_THRESHOLD = 100
+# Maximum number of user IDs in a single IN (...) clause on SQLite
+SQLITE_IN_CHUNK = 500
+
+# Result of a deduplication future whose batch failed to persist
+_FAILED = object()
+
+
+class StateBatch:
+    """
+    The combined state changes of a list of raw state events, e.g. all the state events in a
+    sync response. Only the last event for each piece of state is persisted.
+    """
+
+    # The final member of each (room, user) pair that this batch writes
+    members: dict[tuple[RoomID, UserID], Member]
+    # The target of each member event, in order, including the shared ones
+    member_events: list[tuple[EventID, RoomID, UserID, Member]]
+    power_levels: dict[RoomID, str]
+    encryption: dict[RoomID, str]
+    create: dict[RoomID, str]
+    # The IDs of the events that this batch persists
+    event_ids: set[EventID]
+    # The membership before each member event, filled in when the batch is persisted
+    prev_members: dict[EventID, Member | None]
+    # The keys this batch claimed in the state store's deduplication map
+    claimed: dict[tuple[RoomID, EventID], asyncio.Future]
+    # Events that another batch (usually of another client) is persisting
+    shared: dict[EventID, asyncio.Future]
+
+    def __init__(self) -> None:
+        self.members = {}
+        self.member_events = []
+        self.power_levels = {}
+        self.encryption = {}
+        self.create = {}
+        self.event_ids = set()
+        self.prev_members = {}
+        self.claimed = {}
+        self.shared = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.event_ids or self.shared)
+
+    def __len__(self) -> int:
+        return len(self.event_ids) + len(self.shared)
+
+    def add(self, evt: dict[str, Any], shared: asyncio.Future | None = None) -> bool:
+        """
+        Add a raw state event to the batch. The event must have a ``room_id``.
+
+        If ``shared`` is set, another batch is persisting the event. It's still used for
+        computing the previous memberships of this batch, but this batch won't write it, and
+        earlier changes to the same state in this batch aren't written either, so that they
+        can't overwrite the newer state.
+
+        Returns:
+            ``True`` if the event was added, ``False`` if it's malformed and should be handled
+            through :meth:`StateStore.update_state` instead.
+        """
+        event_id = evt.get("event_id")
+        room_id = evt.get("room_id")
+        state_key = evt.get("state_key")
+        content = evt.get("content")
+        if (
+            not isinstance(event_id, str)
+            or not isinstance(room_id, str)
+            or not isinstance(state_key, str)
+            or not isinstance(content, dict)
+        ):
+            return False
+        evt_type = evt.get("type")
+        if evt_type == EventType.ROOM_MEMBER.t:
+            displayname = content.get("displayname")
+            avatar_url = content.get("avatar_url")
+            if not isinstance(displayname, (str, type(None))) or not isinstance(
+                avatar_url, (str, type(None))
+            ):
+                return False
+            try:
+                membership = Membership(content.get("membership"))
+            except ValueError:
+                return False
+            member = Member(membership=membership, displayname=displayname, avatar_url=avatar_url)
+            self.member_events.append((event_id, room_id, state_key, member))
+            if shared:
+                self.members.pop((room_id, state_key), None)
+            else:
+                self.members[(room_id, state_key)] = member
+        elif evt_type == EventType.ROOM_POWER_LEVELS.t:
+            self._set_room_state(self.power_levels, room_id, json.dumps(content), shared)
+        elif evt_type == EventType.ROOM_ENCRYPTION.t:
+            self._set_room_state(self.encryption, room_id, json.dumps(content), shared)
+        elif evt_type == EventType.ROOM_CREATE.t and evt.get("sender"):
+            self._set_room_state(self.create, room_id, json.dumps(evt), shared)
+        if shared:
+            self.shared[event_id] = shared
+        else:
+            self.event_ids.add(event_id)
+        return True
+
+    @staticmethod
+    def _set_room_state(
+        values: dict[RoomID, str], room_id: RoomID, value: str, shared: asyncio.Future | None
+    ) -> None:
+        if shared:
+            values.pop(room_id, None)
+        else:
+            values[room_id] = value
+
+    def mark_persisted(self, evt: StateEvent) -> bool:
+        """
+        Check if a deserialized state event was persisted as a part of this batch, or is being
+        persisted by another batch. If it was, the previous membership is stored in the event
+        like :meth:`StateStore.update_state` does.
+        """
+        if evt.event_id not in self.event_ids:
+            shared = self.shared.get(evt.event_id)
+            if shared is None or (shared.done() and shared.result() is _FAILED):
+                return False
+        if evt.type == EventType.ROOM_MEMBER:
+            evt.unsigned["mautrix_prev_membership"] = self.prev_members.get(evt.event_id)
+        return True
+
+
+class PgStateStore(_BaseStateStore):
+    """
+    The mautrix state store with batched persistence of state events from syncs.
+
+    All clients share one state store, so when many clients are in the same rooms, they all
+    receive the same state events. The store remembers the most recent ``dedup_size`` state
+    events by ``(room_id, event_id)``, and only the first batch that contains an event persists
+    it. Other batches don't write the same rows again and don't wait for the first batch either,
+    but each batch still computes the previous memberships from the store itself.
+    """
+
+    dedup_size: int
+    _state_events: OrderedDict[tuple[RoomID, EventID], asyncio.Future]
+
+    def __init__(self, db: Database, dedup_size: int = 50000) -> None:
+        super().__init__(db)
+        self.dedup_size = dedup_size
+        self._state_events = OrderedDict()
+
+    def add_to_batch(self, batch: StateBatch, evt: dict[str, Any]) -> bool:
+        """
+        Add a raw state event to a batch, unless another batch has already claimed it.
+
+        Returns:
+            ``True`` if the event will be handled by the batch, ``False`` if it should be handled
+            through :meth:`update_state` instead.
+        """
+        key = (evt.get("room_id"), evt.get("event_id"))
+        if key in batch.claimed:
+            # The same event can be both in the state and timeline sections of a sync
+            return True
+        fut = self._state_events.get(key)
+        if fut is not None and not (fut.done() and fut.result() is _FAILED):
+            self._state_events.move_to_end(key)
+            return batch.add(evt, shared=fut)
+        if not batch.add(evt):
+            return False
+        if self.dedup_size > 0:
+            fut = self._state_events[key] = asyncio.get_running_loop().create_future()
+            batch.claimed[key] = fut
+            while len(self._state_events) > self.dedup_size:
+                self._state_events.popitem(last=False)
+        return True
+
+    def release_batch(self, batch: StateBatch) -> None:
+        """
+        Release the events claimed by a batch that won't be persisted, so that other batches
+        waiting for them stop waiting and the next batch containing them persists them instead.
+        This does nothing for a batch that was successfully persisted.
+        """
+        for key, fut in batch.claimed.items():
+            if fut.done():
+                continue
+            if self._state_events.get(key) is fut:
+                del self._state_events[key]
+            fut.set_result(_FAILED)
+
+    async def _get_members_for_batch(
+        self, conn: Connection, keys: Iterable[tuple[RoomID, UserID]]
+    ) -> dict[tuple[RoomID, UserID], Member]:
+        users_by_room: dict[RoomID, list[UserID]] = defaultdict(list)
+        for room_id, user_id in keys:
+            users_by_room[room_id].append(user_id)
+        members = {}
+        for room_id, user_ids in users_by_room.items():
+            if self.db.scheme in (Scheme.POSTGRES, Scheme.COCKROACH):
+                q = (
+                    "SELECT user_id, membership, displayname, avatar_url FROM mx_user_profile "
+                    "WHERE room_id=$1 AND user_id=ANY($2)"
+                )
+                rows = await conn.fetch(q, room_id, user_ids)
+            else:
+                rows = []
+                for i in range(0, len(user_ids), SQLITE_IN_CHUNK):
+                    chunk = user_ids[i : i + SQLITE_IN_CHUNK]
+                    placeholders = ("?," * len(chunk)).rstrip(",")
+                    q = (
+                        "SELECT user_id, membership, displayname, avatar_url "
+                        f"FROM mx_user_profile WHERE room_id=? AND user_id IN ({placeholders})"
+                    )
+                    rows += await conn.fetch(q, room_id, *chunk)
+            for row in rows:
+                members[(room_id, row["user_id"])] = Member.deserialize(dict(row))
+        return members
+
+    async def _upsert_members_for_batch(
+        self, conn: Connection, records: list[tuple[RoomID, UserID, str, str, str]]
+    ) -> None:
+        if self.db.scheme == Scheme.POSTGRES and len(records) >= COPY_THRESHOLD:
+            columns = ["room_id", "user_id", "membership", "displayname", "avatar_url"]
+            await conn.execute(
+                "CREATE TEMPORARY TABLE mx_user_profile_batch "
+                "(LIKE mx_user_profile INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            await conn.copy_records_to_table(
+                "mx_user_profile_batch", records=records, columns=columns
+            )
+            await conn.execute(
+                "INSERT INTO mx_user_profile (room_id, user_id, membership, displayname, "
+                "                             avatar_url) "
+                "SELECT room_id, user_id, membership, displayname, avatar_url "
+                "FROM mx_user_profile_batch "
+                "ON CONFLICT (room_id, user_id) DO UPDATE SET membership=excluded.membership, "
+                "    displayname=excluded.displayname, avatar_url=excluded.avatar_url"
+            )
+        else:
+            q = (
+                "INSERT INTO mx_user_profile (room_id, user_id, membership, displayname, "
+                "                             avatar_url) "
+                "VALUES ($1, $2, $3, $4, $5) "
+                "ON CONFLICT (room_id, user_id) DO UPDATE SET membership=$3, displayname=$4,"
+                "                                             avatar_url=$5"
+            )
+            await conn.executemany(q, records)
+
+    async def update_state_batch(self, batch: StateBatch) -> None:
+        """
+        Persist all the state changes in a batch in a single transaction. This is equivalent to
+        calling :meth:`update_state` for each event in the batch, but uses a few multi-row
+        queries instead of one or two queries per event.
+
+        Events that were claimed by other batches aren't persisted again, and this doesn't wait
+        for the other batches, so like with :meth:`update_state` in other clients, those events
+        may not be stored yet when this returns.
+        """
+        try:
+            if batch.event_ids or batch.member_events:
+                await self._persist_state_batch(batch)
+        except BaseException:
+            self.release_batch(batch)
+            raise
+        for fut in batch.claimed.values():
+            fut.set_result(True)
+        STATE_BATCH_EVENTS.labels(type="shared").inc(len(batch.shared))
+
+    async def _persist_state_batch(self, batch: StateBatch) -> None:
+        async with self.db.acquire() as conn, conn.transaction():
+            if batch.member_events:
+                keys = {(room_id, user_id) for _, room_id, user_id, _ in batch.member_events}
+                current = await self._get_members_for_batch(conn, keys)
+                for event_id, room_id, user_id, member in batch.member_events:
+                    batch.prev_members[event_id] = current.get((room_id, user_id))
+                    current[(room_id, user_id)] = member
+            if batch.members:
+                await self._upsert_members_for_batch(
+                    conn,
+                    [
+                        (room_id, user_id, m.membership.value, m.displayname, m.avatar_url)
+                        for (room_id, user_id), m in batch.members.items()
+                    ],
+                )
+            for column, values in (
+                ("power_levels", batch.power_levels),
+                ("encryption", batch.encryption),
+                ("create_event", batch.create),
+            ):
+                if not values:
+                    continue
+                if column == "encryption":
+                    q = (
+                        "INSERT INTO mx_room_state (room_id, is_encrypted, encryption) "
+                        "VALUES ($1, true, $2) "
+                        "ON CONFLICT (room_id) DO UPDATE SET is_encrypted=true, encryption=$2"
+                    )
+                else:
+                    q = (
+                        f"INSERT INTO mx_room_state (room_id, {column}) VALUES ($1, $2) "
+                        f"ON CONFLICT (room_id) DO UPDATE SET {column}=$2"
+                    )
+                await conn.executemany(q, list(values.items()))
+        member_count = sum(evt[0] in batch.event_ids for evt in batch.member_events)
+        STATE_BATCH_EVENTS.labels(type="member").inc(member_count)
+        STATE_BATCH_EVENTS.labels(type="other").inc(len(batch.event_ids) - member_count)
+
+
+class _CachedRoom:
+    __slots__ = ("version", "members", "power_levels", "create", "is_encrypted", "encryption")
+
+    version: int
+    members: dict[UserID, Member | None]
+
+    def __init__(self) -> None:
+        self.version = 0
+        self.members = {}
+        self.power_levels = _MISSING
+        self.create = _MISSING
+        self.is_encrypted = _MISSING
+        self.encryption = _MISSING
+
+
+class CachedPgStateStore(PgStateStore):
+    """
+    A state store with a bounded write-through cache for room members, power levels, create
+    events and encryption info. Rooms are evicted in least recently used order.
+
+    All writes go to the database first and then update the cache, so the cache can only be
+    stale if something other than this process writes to the state tables. Each cached room has
+    a version that's incremented on every write, which prevents a database read that was started
+    before a write from overwriting the cache with the old value.
+    """
+
+    cache_size: int
+    _rooms: OrderedDict[RoomID, _CachedRoom]
+
+    def __init__(self, db: Database, cache_size: int = 10000, dedup_size: int = 50000) -> None:
+        super().__init__(db, dedup_size=dedup_size)
+        self.cache_size = cache_size
+        self._rooms = OrderedDict()
+
+    def _get_room(self, room_id: RoomID) -> _CachedRoom:
+        try:
+            room = self._rooms[room_id]
+        except KeyError:
+            room = self._rooms[room_id] = _CachedRoom()
+            while len(self._rooms) > self.cache_size:
+                self._rooms.popitem(last=False)
+            CACHED_ROOMS.set(len(self._rooms))
+        else:
+            self._rooms.move_to_end(room_id)
+        return room
+
+    def _modify_room(self, room_id: RoomID) -> _CachedRoom:
+        room = self._get_room(room_id)
+        room.version += 1
+        return room
+
+    def invalidate(self, room_id: RoomID | None = None) -> None:
+        """Drop the cached state of a room, or all rooms if ``room_id`` is ``None``."""
+        if room_id is None:
+            self._rooms.clear()
+        else:
+            self._rooms.pop(room_id, None)
+        CACHED_ROOMS.set(len(self._rooms))
+
+    async def _cached(
+        self,
+        kind: str,
+        room_id: RoomID,
+        get: Callable[[_CachedRoom], Any],
+        put: Callable[[_CachedRoom, T], None],
+        fetch: Callable[[], Awaitable[T]],
+    ) -> T:
+        room = self._get_room(room_id)
+        value = get(room)
+        if value is not _MISSING:
+            CACHE_LOOKUPS.labels(kind=kind, result="hit").inc()
+            return value
+        CACHE_LOOKUPS.labels(kind=kind, result="miss").inc()
+        version = room.version
+        value = await fetch()
+        if self._rooms.get(room_id) is room and room.version == version:
+            put(room, value)
+        return value
+
+    async def get_member(self, room_id: RoomID, user_id: UserID) -> Member | None:
+        def put(room: _CachedRoom, value: Member | None) -> None:
+            room.members[user_id] = value
+
+        return await self._cached(
+            "member",
+            room_id,
+            lambda room: room.members.get(user_id, _MISSING),
+            put,
+            lambda: super(CachedPgStateStore, self).get_member(room_id, user_id),
+        )
+
+    async def set_member(
+        self, room_id: RoomID, user_id: UserID, member: Member | MemberStateEventContent
+    ) -> None:
+        await super().set_member(room_id, user_id, member)
+        self._modify_room(room_id).members[user_id] = Member(
+            membership=member.membership,
+            displayname=member.displayname,
+            avatar_url=member.avatar_url,
+        )
+
+    async def set_membership(
+        self, room_id: RoomID, user_id: UserID, membership: Membership
+    ) -> None:
+        await super().set_membership(room_id, user_id, membership)
+        room = self._modify_room(room_id)
+        member = room.members.get(user_id)
+        if member is not None:
+            room.members[user_id] = Member(
+                membership=membership,
+                displayname=member.displayname,
+                avatar_url=member.avatar_url,
+            )
+        else:
+            # The profile fields of a new row are left null
+            room.members[user_id] = Member(membership=membership)
+
+    async def set_members(
+        self,
+        room_id: RoomID,
+        members: dict[UserID, Member | MemberStateEventContent],
+        only_membership: Membership | None = None,
+    ) -> None:
+        await super().set_members(room_id, members, only_membership)
+        # This replaces an arbitrary subset of the member list, so it's simpler to refetch
+        # individual members when they're needed than to patch the cache.
+        self._modify_room(room_id).members.clear()
+
+    async def get_power_levels(self, room_id: RoomID) -> PowerLevelStateEventContent | None:
+        def put(room: _CachedRoom, value: PowerLevelStateEventContent | None) -> None:
+            room.power_levels = value
+
+        return await self._cached(
+            "power_levels",
+            room_id,
+            lambda room: room.power_levels,
+            put,
+            lambda: super(CachedPgStateStore, self).get_power_levels(room_id),
+        )
+
+    async def has_power_levels_cached(self, room_id: RoomID) -> bool:
+        return await self.get_power_levels(room_id) is not None
+
+    async def set_power_levels(
+        self, room_id: RoomID, content: PowerLevelStateEventContent | dict[str, Any]
+    ) -> None:
+        await super().set_power_levels(room_id, content)
+        room = self._modify_room(room_id)
+        if isinstance(content, dict):
+            content = PowerLevelStateEventContent.deserialize(content)
+        room.power_levels = content
+
+    async def get_create(self, room_id: RoomID) -> StateEvent | None:
+        def put(room: _CachedRoom, value: StateEvent | None) -> None:
+            room.create = value
+
+        return await self._cached(
+            "create",
+            room_id,
+            lambda room: room.create,
+            put,
+            lambda: super(CachedPgStateStore, self).get_create(room_id),
+        )
+
+    async def has_create_cached(self, room_id: RoomID) -> bool:
+        return await self.get_create(room_id) is not None
+
+    async def set_create(self, event: StateEvent) -> None:
+        await super().set_create(event)
+        room = self._modify_room(event.room_id)
+        if isinstance(event, dict):
+            event = StateEvent.deserialize(event)
+        room.create = event
+
+    async def is_encrypted(self, room_id: RoomID) -> bool | None:
+        def put(room: _CachedRoom, value: bool | None) -> None:
+            room.is_encrypted = value
+
+        return await self._cached(
+            "encryption",
+            room_id,
+            lambda room: room.is_encrypted,
+            put,
+            lambda: super(CachedPgStateStore, self).is_encrypted(room_id),
+        )
+
+    async def get_encryption_info(self, room_id: RoomID) -> RoomEncryptionStateEventContent | None:
+        def put(room: _CachedRoom, value: RoomEncryptionStateEventContent | None) -> None:
+            room.encryption = value
+
+        return await self._cached(
+            "encryption",
+            room_id,
+            lambda room: room.encryption,
+            put,
+            lambda: super(CachedPgStateStore, self).get_encryption_info(room_id),
+        )
+
+    async def set_encryption_info(
+        self, room_id: RoomID, content: RoomEncryptionStateEventContent | dict[str, Any]
+    ) -> None:
+        await super().set_encryption_info(room_id, content)
+        room = self._modify_room(room_id)
+        if isinstance(content, dict):
+            content = RoomEncryptionStateEventContent.deserialize(content)
+        room.is_encrypted = True
+        room.encryption = content
+
+    async def update_state_batch(self, batch: StateBatch) -> None:
+        await super().update_state_batch(batch)
+        # Only rooms that are already cached are updated, so that a large sync doesn't evict
+        # all the rooms that are actually being used.
+        for (room_id, user_id), member in batch.members.items():
+            room = self._rooms.get(room_id)
+            if room is not None:
+                room.version += 1
+                room.members[user_id] = member
+        for room_id in batch.power_levels.keys() | batch.encryption.keys() | batch.create.keys():
+            room = self._rooms.get(room_id)
+            if room is None:
+                continue
+            room.version += 1
+            # The raw JSON is parsed lazily on the next lookup
+            if room_id in batch.power_levels:
+                room.power_levels = _MISSING
+            if room_id in batch.encryption:
+                room.is_encrypted = room.encryption = _MISSING
+            if room_id in batch.create:
+                room.create = _MISSING
+
 
-__all__ = ["PgStateStore"]
+__all__ = ["PgStateStore", "CachedPgStateStore", "StateBatch"]
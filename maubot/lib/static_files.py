@@ -0,0 +1,147 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from aiohttp import hdrs, web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "image/svg+xml",
+}
+
+
+def _guess_type(path: str) -> str:
+    if path.endswith(".map"):
+        return "application/json"
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def _is_compressible(mime: str) -> bool:
+    return mime.startswith("text/") or mime in COMPRESSIBLE_TYPES
+
+
+def _parse_accept_encoding(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+class StaticFile:
+    """
+    An in-memory static file with a content hash ETag and optional precompressed variants.
+    """
+
+    data: bytes
+    mime: str
+    cache_control: str
+    etag: str
+    variants: dict[str, bytes]
+
+    def __init__(self, data: bytes, mime: str, cache_control: str = CACHE_REVALIDATE) -> None:
+        self.data = data
+        self.mime = mime
+        self.cache_control = cache_control
+        # The ETag is weak because the same ETag is used for all content encodings
+        self.etag = f'W/"{hashlib.sha256(data).hexdigest()[:32]}"'
+        self.variants = {}
+
+    @classmethod
+    def read(cls, path: str, cache_control: str = CACHE_REVALIDATE) -> StaticFile:
+        with open(path, "rb") as file:
+            return cls(file.read(), _guess_type(path), cache_control)
+
+    def precompress(self) -> None:
+        if not _is_compressible(self.mime):
+            return
+        gzipped = gzip.compress(self.data, compresslevel=9, mtime=0)
+        if len(gzipped) < len(self.data):
+            self.variants["gzip"] = gzipped
+        if brotli is not None:
+            brotlied = brotli.compress(self.data)
+            if len(brotlied) < len(self.data):
+                self.variants["br"] = brotlied
+
+    def _is_not_modified(self, request: web.Request) -> bool:
+        if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+        if not if_none_match:
+            return False
+        etag = self.etag.removeprefix("W/")
+        return any(
+            tag.strip() == "*" or tag.strip().removeprefix("W/") == etag
+            for tag in if_none_match.split(",")
+        )
+
+    def respond(self, request: web.Request) -> web.Response:
+        headers = {
+            hdrs.ETAG: self.etag,
+            hdrs.CACHE_CONTROL: self.cache_control,
+            hdrs.VARY: hdrs.ACCEPT_ENCODING,
+        }
+        if self._is_not_modified(request):
+            return web.Response(status=304, headers=headers)
+        body = self.data
+        if self.variants:
+            accepted = _parse_accept_encoding(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+            for encoding in ("br", "gzip"):
+                if encoding in accepted and encoding in self.variants:
+                    body = self.variants[encoding]
+                    headers[hdrs.CONTENT_ENCODING] = encoding
+                    break
+        return web.Response(body=body, content_type=self.mime, headers=headers)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return self.respond(request)
+
+
+def read_directory(directory: str, cache_control: str = CACHE_REVALIDATE) -> dict[str, StaticFile]:
+    """
+    Read all files in a directory (recursively) into memory.
+
+    Returns:
+        A dict from the path relative to the directory (with ``/`` as the separator)
+        to the file.
+    """
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            rel_path = os.path.relpath(path, directory).replace(os.sep, "/")
+            files[rel_path] = StaticFile.read(path, cache_control)
+    return files
@@ -0,0 +1,93 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Hashable
+from collections import OrderedDict
+import time
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Get the number of seconds until a token is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class TokenBucketStore:
+    """
+    A map of token buckets with a maximum size. When the map is full, the least recently used
+    bucket is dropped, which at worst lets that key make a few extra requests.
+    """
+
+    max_size: int
+    _buckets: OrderedDict[Hashable, TokenBucket]
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def try_take(self, key: Hashable, rate: float, burst: float) -> float:
+        """
+        Take a token from the bucket of the given key, creating the bucket if necessary.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        try:
+            bucket = self._buckets[key]
+        except KeyError:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        delay = bucket.delay(time.monotonic())
+        if delay == 0:
+            bucket.take()
+        return delay
+
+    def clear(self) -> None:
+        self._buckets.clear()
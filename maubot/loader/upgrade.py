@@ -0,0 +1,212 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from enum import Enum
+from time import time
+import asyncio
+import logging
+import traceback
+
+from .zip import MaubotZipImportError, ZippedPluginLoader
+
+if TYPE_CHECKING:
+    from ..config import Config
+    from ..instance import PluginInstance
+
+
+class UpgradeState(Enum):
+    RUNNING = "running"
+    COMPLETED = "completed"
+    ROLLED_BACK = "rolled_back"
+    FAILED = "failed"
+
+
+class PluginUpgrade:
+    """
+    Restarts the instances of a plugin on a new version, with an optional rollback.
+
+    All instances share the same plugin modules, so two versions can't run side by side: every
+    instance is stopped, the new version is loaded and the instances are started again, like a
+    plain reload. If the previous version is still available and ``max_failure_ratio`` is below
+    1, the upgrade then waits for the health check delay and checks that the instances are still
+    running. If too many of them have failed, the plugin is reloaded from the previous version
+    and all instances are started on it again. Otherwise instances that fail to start are only
+    disabled.
+    """
+
+    log: logging.Logger = logging.getLogger("maubot.loader.upgrade")
+    # The most recent upgrade of each plugin, used for reporting progress
+    active: dict[str, PluginUpgrade] = {}
+
+    loader: ZippedPluginLoader
+    new_path: str | None
+    old_path: str | None
+    new_sha256: str | None
+    old_sha256: str | None
+    health_check_delay: float
+    max_failure_ratio: float
+
+    state: UpgradeState
+    error: str | None
+    stacktrace: str | None
+    started_at: int
+    finished_at: int | None
+    total: int
+    upgraded: list[PluginInstance]
+    failed: list[PluginInstance]
+    _was_running: set[PluginInstance]
+
+    def __init__(
+        self,
+        loader: ZippedPluginLoader,
+        new_path: str | None = None,
+        old_path: str | None = None,
+        health_check_delay: float = 0,
+        max_failure_ratio: float = 1,
+        new_sha256: str | None = None,
+        old_sha256: str | None = None,
+    ) -> None:
+        """
+        Args:
+            loader: The plugin to upgrade.
+            new_path: The path to load the new version from. If ``None``, the plugin is reloaded
+                from its current path.
+            old_path: The path of the currently loaded version, which is used for rolling back.
+                If ``None``, a failed upgrade is never rolled back.
+            health_check_delay: How long to wait after starting the instances before checking
+                them. Only used if the upgrade can be rolled back.
+            max_failure_ratio: The ratio of failed instances above which the upgrade is rolled
+                back. 1 or more disables rolling back.
+            new_sha256: The hash of the new version, if known, so that it isn't hashed again.
+            old_sha256: The hash of the current version, if known.
+        """
+        self.loader = loader
+        self.new_path = new_path
+        self.old_path = old_path
+        self.new_sha256 = new_sha256
+        self.old_sha256 = old_sha256
+        self.health_check_delay = health_check_delay
+        self.max_failure_ratio = max_failure_ratio
+        self.state = UpgradeState.RUNNING
+        self.error = None
+        self.stacktrace = None
+        self.started_at = int(time() * 1000)
+        self.finished_at = None
+        self.total = 0
+        self.upgraded = []
+        self.failed = []
+        self._was_running = set()
+        self.active[loader.meta.id] = self
+
+    @classmethod
+    def from_config(
+        cls,
+        loader: ZippedPluginLoader,
+        config: Config,
+        new_path: str | None = None,
+        old_path: str | None = None,
+        new_sha256: str | None = None,
+        old_sha256: str | None = None,
+    ) -> PluginUpgrade:
+        return cls(
+            loader,
+            new_path=new_path,
+            old_path=old_path,
+            new_sha256=new_sha256,
+            old_sha256=old_sha256,
+            health_check_delay=config["plugin_upgrades.health_check_delay"],
+            max_failure_ratio=config["plugin_upgrades.max_failure_ratio"],
+        )
+
+    @classmethod
+    def is_running(cls, plugin_id: str) -> bool:
+        upgrade = cls.active.get(plugin_id)
+        return upgrade is not None and upgrade.state == UpgradeState.RUNNING
+
+    @property
+    def can_roll_back(self) -> bool:
+        return self.old_path is not None and self.max_failure_ratio < 1
+
+    def to_dict(self) -> dict:
+        return {
+            "plugin": self.loader.meta.id,
+            "version": str(self.loader.meta.version),
+            "state": self.state.value,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "total": self.total,
+            "upgraded": len(self.upgraded),
+            "failed": [instance.id for instance in self.failed],
+        }
+
+    def _is_healthy(self, instance: PluginInstance) -> bool:
+        return instance.started or instance not in self._was_running
+
+    async def run(self) -> None:
+        try:
+            await self._run()
+        except Exception as e:
+            self.log.exception(f"Unexpected error upgrading {self.loader.meta.id}")
+            self.state = UpgradeState.FAILED
+            self.error = str(e)
+            self.stacktrace = traceback.format_exc()
+        finally:
+            self.finished_at = int(time() * 1000)
+
+    async def _run(self) -> None:
+        plugin_id = self.loader.meta.id
+        instances = [instance for instance in self.loader.references if instance.enabled]
+        self.total = len(instances)
+        self._was_running = {instance for instance in instances if instance.started}
+        await self.loader.stop_instances()
+        try:
+            await self.loader.reload(new_path=self.new_path, sha256=self.new_sha256)
+        except MaubotZipImportError as e:
+            self.error = str(e)
+            self.stacktrace = traceback.format_exc()
+            self.state = UpgradeState.FAILED
+            if self.old_path:
+                await self.loader.reload(new_path=self.old_path, sha256=self.old_sha256)
+                await self.loader.start_instances()
+            return
+        await asyncio.gather(*[instance.start() for instance in instances])
+        self.upgraded = instances
+        if self.can_roll_back and self.health_check_delay > 0:
+            await asyncio.sleep(self.health_check_delay)
+        self.failed = [instance for instance in instances if not self._is_healthy(instance)]
+        if self.can_roll_back and len(self.failed) > len(instances) * self.max_failure_ratio:
+            self.error = f"{len(self.failed)} out of {len(instances)} upgraded instances failed"
+            self.log.warning(f"Rolling back upgrade of {plugin_id}: {self.error}")
+            await self._rollback()
+            return
+        self.state = UpgradeState.COMPLETED
+        self.log.info(
+            f"Upgraded {self.total} instances of {plugin_id} to v{self.loader.meta.version}"
+            + (f" ({len(self.failed)} failed)" if self.failed else "")
+        )
+
+    async def _rollback(self) -> None:
+        await self.loader.stop_instances()
+        for instance in self.failed:
+            # Failing to start disables the instance, so re-enable it for the old version
+            await instance.update_enabled(True)
+        await self.loader.reload(new_path=self.old_path, sha256=self.old_sha256)
+        await self.loader.start_instances()
+        self.state = UpgradeState.ROLLED_BACK
+        self.log.info(f"Rolled back {self.loader.meta.id} to v{self.loader.meta.version}")
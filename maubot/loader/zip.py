@@ -17,8 +17,11 @@ from __future__ import annotations
 
 from time import time
 from zipfile import BadZipFile, ZipFile
+import asyncio
+import hashlib
 import logging
 import os
+import shutil
 import sys
 
 from packaging.version import Version
@@ -53,13 +56,28 @@ class MaubotZipLoadError(MaubotZipImportError):
     pass
 
 
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(64 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def content_addressed_name(plugin_id: str, version: Version | str, sha256: str) -> str:
+    return f"{plugin_id}-v{version}-{sha256[:16]}.mbp"
+
+
 class ZippedPluginLoader(PluginLoader):
     path_cache: dict[str, ZippedPluginLoader] = {}
     log: logging.Logger = logging.getLogger("maubot.loader.zip")
     trash_path: str = "delete"
+    history_path: str | None = None
+    history_size: int = 5
     directories: list[str] = []
 
     path: str | None
+    sha256: str | None
     meta: PluginMeta | None
     main_class: str | None
     main_module: str | None
@@ -67,9 +85,11 @@ class ZippedPluginLoader(PluginLoader):
     _importer: zipimporter | None
     _file: ZipFile | None
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, sha256: str | None = None) -> None:
         super().__init__()
         self.path = path
+        # The hash is computed lazily in load() unless the caller already knows it
+        self.sha256 = sha256
         self.meta = None
         self.main_class = None
         self.main_module = None
@@ -90,15 +110,15 @@ class ZippedPluginLoader(PluginLoader):
         self.log.debug(f"Preloaded plugin {self.meta.id} from {self.path}")
 
     def to_dict(self) -> dict:
-        return {**super().to_dict(), "path": self.path}
+        return {**super().to_dict(), "path": self.path, "sha256": self.sha256}
 
     @classmethod
-    def get(cls, path: str) -> ZippedPluginLoader:
+    def get(cls, path: str, sha256: str | None = None) -> ZippedPluginLoader:
         path = os.path.abspath(path)
         try:
             return cls.path_cache[path]
         except KeyError:
-            return cls(path)
+            return cls(path, sha256=sha256)
 
     @property
     def source(self) -> str:
@@ -156,7 +176,8 @@ class ZippedPluginLoader(PluginLoader):
 
     @classmethod
     def verify_meta(cls, source) -> tuple[str, Version, DatabaseType | None]:
-        _, meta = cls._read_meta(source)
+        file, meta = cls._read_meta(source)
+        file.close()
         return meta.id, meta.version, meta.database_type if meta.database else None
 
     def _load_meta(self) -> None:
@@ -199,12 +220,25 @@ class ZippedPluginLoader(PluginLoader):
                 importer.remove_cache()
                 raise MaubotZipPreLoadError(f"Module {module} not found in file") from e
 
+    async def get_sha256(self) -> str:
+        """Get the SHA-256 hash of the archive, hashing it in a thread if it's not known yet."""
+        if self.sha256 is None:
+            path = self.path
+            sha256 = await asyncio.get_running_loop().run_in_executor(None, hash_file, path)
+            if self.path != path:
+                # The plugin was reloaded from another file while hashing
+                return await self.get_sha256()
+            self.sha256 = sha256
+        return self.sha256
+
     async def load(self, reset_cache: bool = False) -> type[PluginClass]:
         try:
-            return self._load(reset_cache)
+            plugin = self._load(reset_cache)
         except MaubotZipImportError:
             self.log.exception(f"Failed to load {self.meta.id} v{self.meta.version}")
             raise
+        await self.get_sha256()
+        return plugin
 
     def _load(self, reset_cache: bool = False) -> type[PluginClass]:
         if self._loaded is not None and not reset_cache:
@@ -240,7 +274,9 @@ class ZippedPluginLoader(PluginLoader):
         self.log.debug(f"Loaded and imported plugin {self.meta.id} from {self.path}")
         return plugin
 
-    async def reload(self, new_path: str | None = None) -> type[PluginClass]:
+    async def reload(
+        self, new_path: str | None = None, sha256: str | None = None
+    ) -> type[PluginClass]:
         self._unload()
         if new_path is not None and new_path != self.path:
             try:
@@ -249,8 +285,29 @@ class ZippedPluginLoader(PluginLoader):
                 pass
             self.path = new_path
             self.path_cache[self.path] = self
+        # The file may have changed even if the path didn't
+        self.sha256 = sha256
         return await self.load(reset_cache=True)
 
+    @classmethod
+    def find_by_file(cls, file_path: str) -> ZippedPluginLoader | None:
+        """
+        Find the plugin that a module file belongs to. Modules imported from a plugin have a
+        ``__file__`` (and code objects have a ``co_filename``) inside the ``.mbp`` archive path.
+
+        Args:
+            file_path: The file path of a module or code object.
+
+        Returns:
+            The loader of the plugin the file is in, or ``None`` if it's not in any plugin.
+        """
+        if not file_path:
+            return None
+        for path, loader in list(cls.path_cache.items()):
+            if file_path == path or file_path.startswith(path + os.sep):
+                return loader
+        return None
+
     def _unload(self) -> None:
         for name, mod in list(sys.modules.items()):
             if (getattr(mod, "__file__", "") or "").startswith(self.path):
@@ -294,6 +351,67 @@ class ZippedPluginLoader(PluginLoader):
                 except FileNotFoundError:
                     pass
 
+    @classmethod
+    def archive(cls, file_path: str, plugin_id: str, version: Version, sha256: str) -> None:
+        """
+        Move an old version of a plugin into the history directory, or into the trash if history
+        is disabled. History files are named by their content hash, so re-archiving a version
+        that's already in the history just removes the duplicate.
+        """
+        if not cls.history_path:
+            cls.trash(file_path, reason="update")
+            return
+        history_name = content_addressed_name(plugin_id, version, sha256)
+        history_file = os.path.join(cls.history_path, history_name)
+        try:
+            if os.path.exists(history_file):
+                os.remove(file_path)
+            else:
+                shutil.move(file_path, history_file)
+            # Update the mtime so that the history is ordered by when versions were replaced
+            os.utime(history_file)
+        except OSError as e:
+            cls.log.warning(f"Failed to move {file_path} to history: {e} - trashing instead")
+            cls.trash(file_path, reason="update")
+            return
+        cls._prune_history(plugin_id)
+
+    @classmethod
+    def list_history(cls, plugin_id: str) -> list[dict]:
+        """
+        Get the versions of a plugin in the history directory, newest first.
+        """
+        if not cls.history_path or not os.path.isdir(cls.history_path):
+            return []
+        history = []
+        for file in os.listdir(cls.history_path):
+            if not file.startswith(f"{plugin_id}-v") or not file.endswith(".mbp"):
+                continue
+            path = os.path.join(cls.history_path, file)
+            try:
+                pid, version, _ = cls.verify_meta(path)
+            except MaubotZipImportError:
+                continue
+            if pid != plugin_id:
+                continue
+            history.append(
+                {
+                    "id": pid,
+                    "version": str(version),
+                    "hash": file.removesuffix(".mbp").rsplit("-", 1)[-1],
+                    "path": path,
+                    "archived_at": int(os.path.getmtime(path) * 1000),
+                }
+            )
+        history.sort(key=lambda item: item["archived_at"], reverse=True)
+        return history
+
+    @classmethod
+    def _prune_history(cls, plugin_id: str) -> None:
+        for item in cls.list_history(plugin_id)[cls.history_size :]:
+            cls.log.debug(f"Removing {item['path']} from plugin history")
+            cls.trash(item["path"], reason="history")
+
     @classmethod
     def load_all(cls):
         cls.log.debug("Preloading plugins...")
@@ -314,5 +432,9 @@ class ZippedPluginLoader(PluginLoader):
 
 def init(config: Config) -> None:
     ZippedPluginLoader.trash_path = config["plugin_directories.trash"]
+    ZippedPluginLoader.history_path = config["plugin_directories.history"]
+    ZippedPluginLoader.history_size = config["plugin_directories.history_size"]
+    if ZippedPluginLoader.history_path:
+        os.makedirs(ZippedPluginLoader.history_path, exist_ok=True)
     ZippedPluginLoader.directories = config["plugin_directories.load"]
     ZippedPluginLoader.load_all()
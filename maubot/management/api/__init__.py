@@ -43,6 +43,8 @@ def init(cfg: Config, loop: AbstractEventLoop) -> web.Application:
     for pkg, enabled in cfg["api_features"].items():
         if enabled:
             importlib.import_module(f"maubot.management.api.{pkg}")
-    app = web.Application(loop=loop, middlewares=[auth, error], client_max_size=100 * 1024 * 1024)
+    app = web.Application(
+        loop=loop, middlewares=[auth, error], client_max_size=cfg["server.max_request_size"]
+    )
     app.add_routes(routes)
     return app
@@ -15,19 +15,30 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Iterable, Sequence
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+import base64
+import json
 
 from aiohttp import web
 from asyncpg import PostgresError
 import aiosqlite
 
-from mautrix.util.async_db import Database
+from mautrix.util.async_db import Database, Scheme
 
 from ...instance import PluginInstance
-from ...lib.optionalalchemy import Engine, IntegrityError, OperationalError, asc, desc
+from ...lib.legacy_db import LegacyDatabaseExecutor
+from ...lib.optionalalchemy import Engine, IntegrityError, OperationalError, text
 from .base import routes
 from .responses import resp
 
+# How many rows to fetch from the database cursor at a time when streaming results
+FETCH_CHUNK_SIZE = 500
+
+RowChunks = AsyncIterator[Sequence[Sequence[Any]]]
+DatabaseErrors = (PostgresError, aiosqlite.Error, IntegrityError, OperationalError)
+
 
 @routes.get("/instance/{id}/database")
 async def get_database(request: web.Request) -> web.Response:
@@ -40,8 +51,45 @@ async def get_database(request: web.Request) -> web.Response:
     return web.json_response(await instance.get_db_tables())
 
 
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _parse_key_value(value: Any, column_type: str | None, db: Engine | Database) -> Any:
+    """
+    Convert a primary key value from the ``after`` parameter back into the type the database
+    returned it as, so that it can be compared with the column.
+    """
+    if not isinstance(value, str) or not column_type:
+        return value
+    # Only the first word matters, e.g. "timestamp without time zone" or "VARCHAR(255)"
+    type_name = column_type.split("(")[0].split(" ")[0].lower()
+    if type_name in ("bytea", "blob"):
+        return base64.b64decode(value, validate=True)
+    elif type_name == "date":
+        return date.fromisoformat(value)
+    elif type_name == "timestamp" or (type_name == "datetime" and isinstance(db, Engine)):
+        timestamp = datetime.fromisoformat(value)
+        if isinstance(db, Engine) and db.dialect.name == "sqlite":
+            # SQLAlchemy stores datetimes in SQLite as strings in its own format
+            return timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+        return timestamp
+    return value
+
+
 @routes.get("/instance/{id}/database/{table}")
-async def get_table(request: web.Request) -> web.Response:
+async def get_table(request: web.Request) -> web.StreamResponse:
+    """
+    Get rows from a table.
+
+    Rows are ordered by the primary key by default, and the next page can be fetched by passing
+    the primary key of the last row as a JSON array in the ``after`` query parameter (the JSON
+    response includes it as ``next``). Alternatively, ``order=column:asc|desc`` can be passed
+    (multiple times) for a custom order, which doesn't support pagination.
+
+    With ``format=ndjson``, the first line of the response contains the columns and primary key
+    of the table, and each line after it contains one row.
+    """
     instance_id = request.match_info["id"].lower()
     instance = await PluginInstance.get(instance_id)
     if not instance:
@@ -49,29 +97,74 @@ async def get_table(request: web.Request) -> web.Response:
     elif not instance.inst_db:
         return resp.plugin_has_no_database
     tables = await instance.get_db_tables()
+    table_name = request.match_info.get("table", "")
     try:
-        table = tables[request.match_info.get("table", "")]
+        columns = tables[table_name]["columns"]
     except KeyError:
         return resp.table_not_found
+    primary_key = [name for name, column in columns.items() if column.get("primary")]
     try:
-        order = [tuple(order.split(":")) for order in request.query.getall("order")]
-        order = [
-            (
-                (asc if sort.lower() == "asc" else desc)(table.columns[column])
-                if sort
-                else table.columns[column]
-            )
-            for column, sort in order
+        limit = int(request.query.get("limit", "100"))
+        after = json.loads(request.query["after"]) if "after" in request.query else None
+    except ValueError:
+        return resp.invalid_pagination_params
+    order = []
+    for item in request.query.getall("order", []):
+        column, _, sort = item.partition(":")
+        if column in columns:
+            order.append(f"{_quote(column)} {'DESC' if sort.lower() == 'desc' else 'ASC'}")
+    keyset = bool(primary_key) and not order
+    if limit <= 0 or (
+        after is not None
+        and (not keyset or not isinstance(after, list) or len(after) != len(primary_key))
+    ):
+        return resp.invalid_pagination_params
+    try:
+        params = [
+            _parse_key_value(value, columns[column].get("type"), instance.inst_db)
+            for column, value in zip(primary_key, after or [])
         ]
-    except KeyError:
-        order = []
-    limit = int(request.query.get("limit", "100"))
-    if isinstance(instance.inst_db, Engine):
-        return _execute_query_sqlalchemy(instance, table.select().order_by(*order).limit(limit))
+    except ValueError:
+        return resp.invalid_pagination_params
+
+    is_alchemy = isinstance(instance.inst_db, Engine)
+    placeholders = [f":p{i}" if is_alchemy else f"${i}" for i in range(1, len(params) + 1)]
+    sql_query = f"SELECT * FROM {_quote(table_name)}"
+    if after is not None:
+        key = ", ".join(_quote(column) for column in primary_key)
+        sql_query += f" WHERE ({key}) > ({', '.join(placeholders)})"
+    if keyset:
+        order = [_quote(column) for column in primary_key]
+    if order:
+        sql_query += f" ORDER BY {', '.join(order)}"
+    sql_query += f" LIMIT {limit}"
+
+    def trailer(count: int, last_row: Sequence[Any] | None, result_columns: list[str]) -> dict:
+        if not keyset or count < limit:
+            return {"next": None}
+        row = dict(zip(result_columns, last_row))
+        return {"next": [check_type(row[column]) for column in primary_key]}
+
+    ndjson = request.query.get("format") == "ndjson"
+    rows_as_dict = request.query.get("rows_as_dict", "false").lower() in ("true", "1")
+    try:
+        async with _open_cursor(instance, sql_query, params) as (result_columns, chunks):
+            return await _stream_rows(
+                request,
+                sql_query,
+                result_columns,
+                chunks,
+                rows_as_dict=rows_as_dict,
+                ndjson=ndjson,
+                ndjson_header={"columns": result_columns, "primary_key": primary_key},
+                trailer=trailer,
+            )
+    except DatabaseErrors as e:
+        return _sql_error_response(e, sql_query)
 
 
 @routes.post("/instance/{id}/database/query")
-async def query(request: web.Request) -> web.Response:
+async def query(request: web.Request) -> web.StreamResponse:
     instance_id = request.match_info["id"].lower()
     instance = await PluginInstance.get(instance_id)
     if not instance:
@@ -84,78 +177,221 @@ async def query(request: web.Request) -> web.Response:
     except KeyError:
         return resp.query_missing
     rows_as_dict = data.get("rows_as_dict", False)
+    ndjson = data.get("format") == "ndjson"
     if isinstance(instance.inst_db, Engine):
-        return _execute_query_sqlalchemy(instance, sql_query, rows_as_dict)
+        return await _execute_query_sqlalchemy(request, instance, sql_query, rows_as_dict, ndjson)
     elif isinstance(instance.inst_db, Database):
         try:
-            return await _execute_query_asyncpg(instance, sql_query, rows_as_dict)
-        except (PostgresError, aiosqlite.Error) as e:
-            return resp.sql_error(e, sql_query)
+            return await _execute_query_asyncpg(request, instance, sql_query, rows_as_dict, ndjson)
+        except DatabaseErrors as e:
+            return _sql_error_response(e, sql_query)
     else:
         return resp.unsupported_plugin_database
 
 
 def check_type(val):
-    if isinstance(val, datetime):
+    if isinstance(val, date):
+        # datetime is a subclass of date
         return val.isoformat()
+    elif isinstance(val, bytes):
+        return base64.b64encode(val).decode()
     return val
 
 
+def _sql_error_fields(error: Exception) -> dict[str, Any]:
+    if isinstance(error, IntegrityError):
+        return {"error": str(error.orig), "errcode": "sql_integrity_error"}
+    elif isinstance(error, OperationalError):
+        return {"error": str(error.orig), "errcode": "sql_operational_error"}
+    return {"error": str(error), "errcode": "sql_error"}
+
+
+def _sql_error_response(error: Exception, sql_query: str) -> web.Response:
+    if isinstance(error, IntegrityError):
+        return resp.sql_integrity_error(error, sql_query)
+    elif isinstance(error, OperationalError):
+        return resp.sql_operational_error(error, sql_query)
+    return resp.sql_error(error, sql_query)
+
+
+@asynccontextmanager
+async def _open_cursor(
+    instance: PluginInstance, sql_query: str, params: list[Any]
+) -> AsyncIterator[tuple[list[str], RowChunks]]:
+    """
+    Execute a query that returns rows and get the column names and an iterator of row chunks.
+    On Postgres, the rows are read through a server-side cursor.
+    """
+    db = instance.inst_db
+    if isinstance(db, Engine):
+        executor = instance.inst_db_executor
+        conn = await executor.run(db.connect)
+        try:
+            res = await executor.run(
+                conn.execution_options(stream_results=True).execute,
+                text(sql_query),
+                **{f"p{i}": value for i, value in enumerate(params, start=1)},
+            )
+            yield list(res.keys()), _iter_sqlalchemy(executor, res)
+        finally:
+            await executor.run(conn.close)
+        return
+    async with db.acquire() as conn:
+        if db.scheme == Scheme.SQLITE:
+            cursor = await conn.execute(sql_query, *params)
+            try:
+                columns = [column[0] for column in cursor.description or []]
+                yield columns, _iter_sqlite(cursor)
+            finally:
+                await cursor.close()
+        else:
+            async with conn.transaction():
+                stmt = await conn.wrapped.prepare(sql_query)
+                columns = [attr.name for attr in stmt.get_attributes()]
+                yield columns, _iter_postgres(await stmt.cursor(*params))
+
+
+async def _iter_sqlalchemy(executor: LegacyDatabaseExecutor, res) -> RowChunks:
+    while rows := await executor.run(res.fetchmany, FETCH_CHUNK_SIZE):
+        yield rows
+
+
+async def _iter_sqlite(cursor: aiosqlite.Cursor) -> RowChunks:
+    while rows := await cursor.fetchmany(FETCH_CHUNK_SIZE):
+        yield rows
+
+
+async def _iter_postgres(cursor) -> RowChunks:
+    while rows := await cursor.fetch(FETCH_CHUNK_SIZE):
+        yield rows
+
+
+def _dump_rows(rows: Iterable[Sequence[Any]], columns: list[str], rows_as_dict: bool) -> list[str]:
+    if rows_as_dict:
+        return [
+            json.dumps({key: check_type(value) for key, value in zip(columns, row)})
+            for row in rows
+        ]
+    return [json.dumps([check_type(value) for value in row]) for row in rows]
+
+
+async def _stream_rows(
+    request: web.Request,
+    sql_query: str,
+    columns: list[str],
+    chunks: RowChunks,
+    rows_as_dict: bool = False,
+    ndjson: bool = False,
+    ndjson_header: dict | None = None,
+    trailer: Callable[[int, Sequence[Any] | None, list[str]], dict] | None = None,
+) -> web.StreamResponse:
+    """
+    Stream rows to the client as they're read from the database.
+
+    The JSON format has the same structure as a non-streamed response (``ok``, ``query``,
+    ``columns`` and ``rows``, plus any fields returned by ``trailer``). The NDJSON format has a
+    header object on the first line, followed by one row per line.
+
+    The first chunk is fetched before the response is started, so errors in the query itself
+    are raised to the caller. If fetching fails after that, the response is ended with an error
+    instead: the JSON object gets ``"ok": false`` and the error, and NDJSON gets a final line
+    with the error.
+    """
+    first_rows = await anext(chunks, None)
+    response = web.StreamResponse()
+    response.content_type = "application/x-ndjson" if ndjson else "application/json"
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    if ndjson:
+        await response.write(json.dumps(ndjson_header or {"columns": columns}).encode() + b"\n")
+    else:
+        start = {"query": sql_query, "columns": columns}
+        await response.write(json.dumps(start)[:-1].encode() + b', "rows": [')
+    count = 0
+    last_row = None
+    error = None
+    rows = first_rows
+    try:
+        while rows:
+            lines = _dump_rows(rows, columns, rows_as_dict)
+            if ndjson:
+                data = "".join(f"{line}\n" for line in lines)
+            else:
+                data = ("," if count > 0 else "") + ",".join(lines)
+            await response.write(data.encode())
+            count += len(rows)
+            last_row = rows[-1]
+            rows = await anext(chunks, None)
+    except DatabaseErrors as e:
+        error = {"ok": False, **_sql_error_fields(e)}
+    if ndjson:
+        if error:
+            await response.write(json.dumps(error).encode() + b"\n")
+    else:
+        end = error or {"ok": True, **(trailer(count, last_row, columns) if trailer else {})}
+        # Splice the trailer fields into the object that was opened at the start
+        await response.write(b"], " + json.dumps(end)[1:].encode())
+    await response.write_eof()
+    return response
+
+
 async def _execute_query_asyncpg(
-    instance: PluginInstance, sql_query: str, rows_as_dict: bool = False
-) -> web.Response:
-    data = {"ok": True, "query": sql_query}
+    request: web.Request,
+    instance: PluginInstance,
+    sql_query: str,
+    rows_as_dict: bool = False,
+    ndjson: bool = False,
+) -> web.StreamResponse:
     if sql_query.upper().startswith("SELECT"):
-        res = await instance.inst_db.fetch(sql_query)
-        data["rows"] = [
-            (
-                {key: check_type(value) for key, value in row.items()}
-                if rows_as_dict
-                else [check_type(value) for value in row]
+        async with _open_cursor(instance, sql_query, []) as (columns, chunks):
+            return await _stream_rows(
+                request, sql_query, columns, chunks, rows_as_dict=rows_as_dict, ndjson=ndjson
             )
-            for row in res
-        ]
-        if len(res) > 0:
-            # TODO can we find column names when there are no rows?
-            data["columns"] = list(res[0].keys())
+    data = {"ok": True, "query": sql_query}
+    res = await instance.inst_db.execute(sql_query)
+    if isinstance(res, str):
+        data["status_msg"] = res
+    elif isinstance(res, aiosqlite.Cursor):
+        data["rowcount"] = res.rowcount
+        # data["inserted_primary_key"] = res.lastrowid
     else:
-        res = await instance.inst_db.execute(sql_query)
-        if isinstance(res, str):
-            data["status_msg"] = res
-        elif isinstance(res, aiosqlite.Cursor):
-            data["rowcount"] = res.rowcount
-            # data["inserted_primary_key"] = res.lastrowid
-        else:
-            data["status_msg"] = "unknown status"
+        data["status_msg"] = "unknown status"
     return web.json_response(data)
 
 
-def _execute_query_sqlalchemy(
-    instance: PluginInstance, sql_query: str, rows_as_dict: bool = False
-) -> web.Response:
+async def _execute_query_sqlalchemy(
+    request: web.Request,
+    instance: PluginInstance,
+    sql_query: str,
+    rows_as_dict: bool = False,
+    ndjson: bool = False,
+) -> web.StreamResponse:
     assert isinstance(instance.inst_db, Engine)
+    executor = instance.inst_db_executor
+    conn = await executor.run(instance.inst_db.connect)
     try:
-        res = instance.inst_db.execute(sql_query)
-    except IntegrityError as e:
-        return resp.sql_integrity_error(e, sql_query)
-    except OperationalError as e:
-        return resp.sql_operational_error(e, sql_query)
-    data = {
-        "ok": True,
-        "query": str(sql_query),
-    }
-    if res.returns_rows:
-        data["rows"] = [
-            (
-                {key: check_type(value) for key, value in row.items()}
-                if rows_as_dict
-                else [check_type(value) for value in row]
+        try:
+            res = await executor.run(
+                conn.execution_options(stream_results=True).execute, sql_query
             )
-            for row in res
-        ]
-        data["columns"] = res.keys()
-    else:
-        data["rowcount"] = res.rowcount
-    if res.is_insert:
-        data["inserted_primary_key"] = res.inserted_primary_key
-    return web.json_response(data)
+            if res.returns_rows:
+                return await _stream_rows(
+                    request,
+                    sql_query,
+                    list(res.keys()),
+                    _iter_sqlalchemy(executor, res),
+                    rows_as_dict=rows_as_dict,
+                    ndjson=ndjson,
+                )
+        except (IntegrityError, OperationalError) as e:
+            return _sql_error_response(e, sql_query)
+        data = {
+            "ok": True,
+            "query": str(sql_query),
+            "rowcount": res.rowcount,
+        }
+        if res.is_insert:
+            data["inserted_primary_key"] = res.inserted_primary_key
+        return web.json_response(data)
+    finally:
+        await executor.run(conn.close)
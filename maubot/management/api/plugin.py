@@ -13,14 +13,18 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import traceback
+import asyncio
 
 from aiohttp import web
 
-from ...loader import MaubotZipImportError, PluginLoader
-from .base import routes
+from ...loader import PluginLoader, ZippedPluginLoader
+from ...loader.upgrade import PluginUpgrade, UpgradeState
+from .base import get_config, routes
 from .responses import resp
 
+# Keep references to background reloads so they don't get garbage collected while running
+_reload_tasks: set[asyncio.Task] = set()
+
 
 @routes.get("/plugins")
 async def get_plugins(_) -> web.Response:
@@ -54,11 +58,32 @@ async def reload_plugin(request: web.Request) -> web.Response:
     plugin = PluginLoader.id_cache.get(plugin_id)
     if not plugin:
         return resp.plugin_not_found
+    elif not isinstance(plugin, ZippedPluginLoader):
+        return resp.unsupported_plugin_loader
+    elif PluginUpgrade.is_running(plugin_id):
+        return resp.plugin_upgrade_in_progress
+
+    upgrade = PluginUpgrade.from_config(plugin, get_config())
+    task = asyncio.create_task(upgrade.run())
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+    if request.query.get("background"):
+        return resp.accepted(upgrade.to_dict())
+    # Don't cancel the reload halfway if the client disconnects
+    await asyncio.shield(task)
+    if upgrade.state == UpgradeState.COMPLETED:
+        return resp.ok
+    elif not upgrade.upgraded:
+        return resp.plugin_reload_error(upgrade.error, upgrade.stacktrace)
+    return resp.plugin_upgrade_error(upgrade.to_dict())
+
 
-    await plugin.stop_instances()
-    try:
-        await plugin.reload()
-    except MaubotZipImportError as e:
-        return resp.plugin_reload_error(str(e), traceback.format_exc())
-    await plugin.start_instances()
-    return resp.ok
+@routes.get("/plugin/{id}/upgrade")
+async def get_plugin_upgrade(request: web.Request) -> web.Response:
+    plugin_id = request.match_info["id"]
+    if plugin_id not in PluginLoader.id_cache:
+        return resp.plugin_not_found
+    upgrade = PluginUpgrade.active.get(plugin_id)
+    if not upgrade:
+        return resp.plugin_upgrade_not_found
+    return resp.found(upgrade.to_dict())
@@ -13,17 +13,23 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from io import BytesIO
-from time import time
+from __future__ import annotations
+
+from typing import BinaryIO
+import asyncio
+import hashlib
 import logging
 import os.path
-import re
+import shutil
+import tempfile
 import traceback
 
 from aiohttp import web
 from packaging.version import Version
 
 from ...loader import DatabaseType, MaubotZipImportError, PluginLoader, ZippedPluginLoader
+from ...loader.upgrade import PluginUpgrade, UpgradeState
+from ...loader.zip import content_addressed_name, hash_file
 from .base import get_config, routes
 from .responses import resp
 
@@ -36,56 +42,154 @@ except ImportError:
 
 log = logging.getLogger("maubot.server.upload")
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Keep references to upgrade tasks so they don't get garbage collected while running
+_upgrade_tasks: set[asyncio.Task] = set()
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def _receive_upload(request: web.Request) -> tuple[str, str]:
+    """
+    Stream the request body into a temporary file in the upload directory.
+
+    Returns:
+        A tuple of the temporary file path and the SHA-256 hash of the content.
+    """
+    config = get_config()
+    # aiohttp's client_max_size only applies to bodies that are read into memory
+    max_size = config["server.max_request_size"]
+    fd, path = tempfile.mkstemp(
+        prefix=".upload-", suffix=".mbp.tmp", dir=config["plugin_directories.upload"]
+    )
+    hasher = hashlib.sha256()
+    size = 0
+    loop = asyncio.get_running_loop()
+
+    def write(file: BinaryIO, chunk: bytes) -> None:
+        hasher.update(chunk)
+        file.write(chunk)
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            async for chunk in request.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge()
+                await loop.run_in_executor(None, write, file, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, hasher.hexdigest()
+
+
+async def _handle_upload(
+    request: web.Request, expected_id: str | None = None, allow_override: bool = True
+) -> web.Response:
+    background = bool(request.query.get("background"))
+    try:
+        tmp_path, sha256 = await _receive_upload(request)
+    except UploadTooLarge:
+        return resp.plugin_too_large
+    try:
+        try:
+            pid, version, db_type = ZippedPluginLoader.verify_meta(tmp_path)
+        except MaubotZipImportError as e:
+            return resp.plugin_import_error(str(e), traceback.format_exc())
+        if db_type == DatabaseType.SQLALCHEMY and not has_alchemy:
+            return resp.sqlalchemy_not_installed
+        if expected_id is not None and pid != expected_id:
+            return resp.pid_mismatch
+        log.debug(f"Received upload of {pid} v{version} (sha256: {sha256})")
+        plugin = PluginLoader.id_cache.get(pid, None)
+        if not plugin:
+            return await upload_new_plugin(tmp_path, pid, version, sha256)
+        elif not allow_override:
+            return resp.plugin_exists
+        elif isinstance(plugin, ZippedPluginLoader):
+            return await upload_replacement_plugin(
+                plugin, tmp_path, version, sha256, background=background
+            )
+        else:
+            return resp.unsupported_plugin_loader
+    finally:
+        # The upload functions move the file into place if they succeed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 
 @routes.put("/plugin/{id}")
 async def put_plugin(request: web.Request) -> web.Response:
-    plugin_id = request.match_info["id"]
-    content = await request.read()
-    file = BytesIO(content)
-    try:
-        pid, version, db_type = ZippedPluginLoader.verify_meta(file)
-    except MaubotZipImportError as e:
-        return resp.plugin_import_error(str(e), traceback.format_exc())
-    if db_type == DatabaseType.SQLALCHEMY and not has_alchemy:
-        return resp.sqlalchemy_not_installed
-    if pid != plugin_id:
-        return resp.pid_mismatch
-    plugin = PluginLoader.id_cache.get(plugin_id, None)
-    if not plugin:
-        return await upload_new_plugin(content, pid, version)
-    elif isinstance(plugin, ZippedPluginLoader):
-        return await upload_replacement_plugin(plugin, content, version)
-    else:
-        return resp.unsupported_plugin_loader
+    return await _handle_upload(request, expected_id=request.match_info["id"])
 
 
 @routes.post("/plugins/upload")
 async def upload_plugin(request: web.Request) -> web.Response:
-    content = await request.read()
-    file = BytesIO(content)
-    try:
-        pid, version, db_type = ZippedPluginLoader.verify_meta(file)
-    except MaubotZipImportError as e:
-        return resp.plugin_import_error(str(e), traceback.format_exc())
-    if db_type == DatabaseType.SQLALCHEMY and not has_alchemy:
-        return resp.sqlalchemy_not_installed
-    plugin = PluginLoader.id_cache.get(pid, None)
+    return await _handle_upload(request, allow_override=bool(request.query.get("allow_override")))
+
+
+@routes.get("/plugin/{id}/history")
+async def get_plugin_history(request: web.Request) -> web.Response:
+    plugin = PluginLoader.id_cache.get(request.match_info["id"], None)
     if not plugin:
-        return await upload_new_plugin(content, pid, version)
-    elif not request.query.get("allow_override"):
-        return resp.plugin_exists
-    elif isinstance(plugin, ZippedPluginLoader):
-        return await upload_replacement_plugin(plugin, content, version)
-    else:
+        return resp.plugin_not_found
+    elif not isinstance(plugin, ZippedPluginLoader):
+        return resp.unsupported_plugin_loader
+    history = ZippedPluginLoader.list_history(plugin.meta.id)
+    for item in history:
+        del item["path"]
+    return resp.found(history)
+
+
+@routes.post("/plugin/{id}/history/{hash}/restore")
+async def restore_plugin_version(request: web.Request) -> web.Response:
+    plugin = PluginLoader.id_cache.get(request.match_info["id"], None)
+    if not plugin:
+        return resp.plugin_not_found
+    elif not isinstance(plugin, ZippedPluginLoader):
         return resp.unsupported_plugin_loader
+    hash_prefix = request.match_info["hash"].lower()
+    for item in ZippedPluginLoader.list_history(plugin.meta.id):
+        if item["hash"] == hash_prefix:
+            history_path = item["path"]
+            break
+    else:
+        return resp.plugin_version_not_found
+    # Copy the file so the restored version also stays in the history
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".restore-", suffix=".mbp.tmp", dir=get_config()["plugin_directories.upload"]
+    )
+    os.close(fd)
+    try:
+        shutil.copyfile(history_path, tmp_path)
+        try:
+            pid, version, _ = ZippedPluginLoader.verify_meta(tmp_path)
+        except MaubotZipImportError as e:
+            return resp.plugin_import_error(str(e), traceback.format_exc())
+        if pid != plugin.meta.id:
+            return resp.pid_mismatch
+        sha256 = await asyncio.get_running_loop().run_in_executor(None, hash_file, tmp_path)
+        log.debug(f"Restoring {pid} v{version} (sha256: {sha256}) from history")
+        return await upload_replacement_plugin(
+            plugin, tmp_path, version, sha256, background=bool(request.query.get("background"))
+        )
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
-async def upload_new_plugin(content: bytes, pid: str, version: Version) -> web.Response:
-    path = os.path.join(get_config()["plugin_directories.upload"], f"{pid}-v{version}.mbp")
-    with open(path, "wb") as p:
-        p.write(content)
+async def upload_new_plugin(
+    tmp_path: str, pid: str, version: Version, sha256: str
+) -> web.Response:
+    path = os.path.join(
+        get_config()["plugin_directories.upload"], content_addressed_name(pid, version, sha256)
+    )
+    os.replace(tmp_path, path)
     try:
-        plugin = ZippedPluginLoader.get(path)
+        plugin = ZippedPluginLoader.get(path, sha256=sha256)
     except MaubotZipImportError as e:
         ZippedPluginLoader.trash(path)
         return resp.plugin_import_error(str(e), traceback.format_exc())
@@ -93,53 +197,57 @@ async def upload_new_plugin(content: bytes, pid: str, version: Version) -> web.R
 
 
 async def upload_replacement_plugin(
-    plugin: ZippedPluginLoader, content: bytes, new_version: Version
+    plugin: ZippedPluginLoader,
+    tmp_path: str,
+    new_version: Version,
+    sha256: str,
+    background: bool = False,
 ) -> web.Response:
+    old_sha256 = await plugin.get_sha256()
+    if old_sha256 == sha256:
+        log.debug(f"Uploaded {plugin.meta.id} is identical to the loaded version, not reloading")
+        return resp.updated(plugin.to_dict())
+    elif PluginUpgrade.is_running(plugin.meta.id):
+        return resp.plugin_upgrade_in_progress
     dirname = os.path.dirname(plugin.path)
-    old_filename = os.path.basename(plugin.path)
-    if str(plugin.meta.version) in old_filename:
-        replacement = (
-            str(new_version)
-            if plugin.meta.version != new_version
-            else f"{new_version}-ts{int(time() * 1000)}"
-        )
-        filename = re.sub(
-            f"{re.escape(str(plugin.meta.version))}(-ts[0-9]+)?", replacement, old_filename
-        )
+    path = os.path.join(dirname, content_addressed_name(plugin.meta.id, new_version, sha256))
+    # The plugin may be in a different load directory than the upload directory, so fall back
+    # to copying if renaming isn't possible.
+    shutil.move(tmp_path, path)
+    upgrade = PluginUpgrade.from_config(
+        plugin,
+        get_config(),
+        new_path=path,
+        old_path=plugin.path,
+        new_sha256=sha256,
+        old_sha256=old_sha256,
+    )
+    task = asyncio.create_task(
+        _run_replacement(upgrade, plugin.meta.version, old_sha256, new_path=path)
+    )
+    _upgrade_tasks.add(task)
+    task.add_done_callback(_upgrade_tasks.discard)
+    if background:
+        return resp.accepted(upgrade.to_dict())
+    # Don't cancel the upgrade halfway if the client disconnects
+    await asyncio.shield(task)
+    if upgrade.state == UpgradeState.COMPLETED:
+        return resp.updated(plugin.to_dict())
+    elif not upgrade.upgraded:
+        return resp.plugin_import_error(upgrade.error, upgrade.stacktrace)
+    return resp.plugin_upgrade_error(upgrade.to_dict())
+
+
+async def _run_replacement(
+    upgrade: PluginUpgrade, old_version: Version, old_sha256: str, new_path: str
+) -> None:
+    plugin = upgrade.loader
+    await upgrade.run()
+    if upgrade.state == UpgradeState.COMPLETED:
+        log.debug(f"Successfully updated {plugin.meta.id}, moving old version to history")
+        ZippedPluginLoader.archive(upgrade.old_path, plugin.meta.id, old_version, old_sha256)
+    elif plugin.path == new_path:
+        log.warning(f"Failed to roll back update of {plugin.meta.id}")
     else:
-        filename = old_filename.rstrip(".mbp")
-        filename = f"{filename}-v{new_version}.mbp"
-    path = os.path.join(dirname, filename)
-    with open(path, "wb") as p:
-        p.write(content)
-    old_path = plugin.path
-    await plugin.stop_instances()
-    try:
-        await plugin.reload(new_path=path)
-    except MaubotZipImportError as e:
-        log.exception(f"Error loading updated version of {plugin.meta.id}, rolling back")
-        try:
-            await plugin.reload(new_path=old_path)
-            await plugin.start_instances()
-        except MaubotZipImportError:
-            log.warning(f"Failed to roll back update of {plugin.meta.id}", exc_info=True)
-        finally:
-            ZippedPluginLoader.trash(path, reason="failed_update")
-        return resp.plugin_import_error(str(e), traceback.format_exc())
-    try:
-        await plugin.start_instances()
-    except Exception as e:
-        log.exception(f"Error starting {plugin.meta.id} instances after update, rolling back")
-        try:
-            await plugin.stop_instances()
-            await plugin.reload(new_path=old_path)
-            await plugin.start_instances()
-        except Exception:
-            log.warning(f"Failed to roll back update of {plugin.meta.id}", exc_info=True)
-        finally:
-            ZippedPluginLoader.trash(path, reason="failed_update")
-        return resp.plugin_reload_error(str(e), traceback.format_exc())
-
-    log.debug(f"Successfully updated {plugin.meta.id}, moving old version to trash")
-    ZippedPluginLoader.trash(old_path, reason="update")
-    return resp.updated(plugin.to_dict())
+        log.warning(f"Failed to update {plugin.meta.id}: {upgrade.error}")
+        ZippedPluginLoader.trash(new_path, reason="failed_update")
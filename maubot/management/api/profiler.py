@@ -0,0 +1,68 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+import logging
+import threading
+
+from aiohttp import web
+
+from ...instance import PluginInstance
+from ...lib.profiler import SamplingProfiler
+from .base import routes
+from .responses import resp
+
+log = logging.getLogger("maubot.server.profiler")
+
+MAX_DURATION = 300
+MAX_RATE = 1000
+
+
+@routes.post("/debug/profile")
+async def profile(request: web.Request) -> web.Response:
+    try:
+        duration = float(request.query.get("duration", "10"))
+        rate = float(request.query.get("rate", "100"))
+    except ValueError:
+        return resp.invalid_profile_params
+    if not 0 < duration <= MAX_DURATION or not 0 < rate <= MAX_RATE:
+        return resp.invalid_profile_params
+    loader = None
+    instance_id = request.query.get("instance")
+    if instance_id:
+        instance = await PluginInstance.get(instance_id.lower())
+        if not instance:
+            return resp.instance_not_found
+        elif not instance.loader:
+            return resp.plugin_type_not_found
+        loader = instance.loader
+    all_threads = request.query.get("all_threads", "false").lower() in ("true", "1")
+    profiler = SamplingProfiler(
+        duration=duration,
+        rate=rate,
+        thread_ids=None if all_threads else {threading.get_ident()},
+        only_loader=loader,
+    )
+    log.info(
+        f"Profiling for {duration} seconds at {rate} Hz"
+        + (f" (only {loader.meta.id} modules)" if loader else "")
+    )
+    await profiler.run_async()
+    return web.Response(
+        text=profiler.collapsed(),
+        content_type="text/plain",
+        headers={"X-Sample-Count": str(profiler.sample_count)},
+    )
@@ -111,6 +111,16 @@ class _Response:
             status=HTTPStatus.BAD_REQUEST,
         )
 
+    @property
+    def plugin_too_large(self) -> web.Response:
+        return web.json_response(
+            {
+                "error": "Uploaded plugin file is too large",
+                "errcode": "plugin_too_large",
+            },
+            status=HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        )
+
     @property
     def pid_mismatch(self) -> web.Response:
         return web.json_response(
@@ -141,6 +151,26 @@ class _Response:
             status=HTTPStatus.BAD_REQUEST,
         )
 
+    @property
+    def invalid_pagination_params(self) -> web.Response:
+        return web.json_response(
+            {
+                "error": "Invalid limit or pagination cursor",
+                "errcode": "invalid_pagination_params",
+            },
+            status=HTTPStatus.BAD_REQUEST,
+        )
+
+    @property
+    def invalid_profile_params(self) -> web.Response:
+        return web.json_response(
+            {
+                "error": "Profile duration or sample rate is invalid",
+                "errcode": "invalid_profile_params",
+            },
+            status=HTTPStatus.BAD_REQUEST,
+        )
+
     @staticmethod
     def sql_error(error: PostgresError | aiosqlite.Error, query: str) -> web.Response:
         return web.json_response(
@@ -219,6 +249,26 @@ class _Response:
             status=HTTPStatus.NOT_FOUND,
         )
 
+    @property
+    def plugin_version_not_found(self) -> web.Response:
+        return web.json_response(
+            {
+                "error": "Plugin version not found in history",
+                "errcode": "plugin_version_not_found",
+            },
+            status=HTTPStatus.NOT_FOUND,
+        )
+
+    @property
+    def plugin_upgrade_not_found(self) -> web.Response:
+        return web.json_response(
+            {
+                "error": "The plugin hasn't been upgraded",
+                "errcode": "plugin_upgrade_not_found",
+            },
+            status=HTTPStatus.NOT_FOUND,
+        )
+
     @property
     def client_not_found(self) -> web.Response:
         return web.json_response(
@@ -376,6 +426,16 @@ class _Response:
             status=HTTPStatus.CONFLICT,
         )
 
+    @property
+    def plugin_upgrade_in_progress(self) -> web.Response:
+        return web.json_response(
+            {
+                "error": "The plugin is already being upgraded",
+                "errcode": "plugin_upgrade_in_progress",
+            },
+            status=HTTPStatus.CONFLICT,
+        )
+
     @property
     def plugin_in_use(self) -> web.Response:
         return web.json_response(
@@ -418,6 +478,17 @@ class _Response:
             status=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
 
+    @staticmethod
+    def plugin_upgrade_error(upgrade: dict) -> web.Response:
+        return web.json_response(
+            {
+                "error": upgrade["error"],
+                "errcode": "plugin_upgrade_fail",
+                "upgrade": upgrade,
+            },
+            status=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+
     @property
     def internal_server_error(self) -> web.Response:
         return web.json_response(
@@ -506,5 +577,9 @@ class _Response:
     def created(data: dict) -> web.Response:
         return web.json_response(data, status=HTTPStatus.CREATED)
 
+    @staticmethod
+    def accepted(data: dict) -> web.Response:
+        return web.json_response(data, status=HTTPStatus.ACCEPTED)
+
 
 resp = _Response()
@@ -24,9 +24,11 @@ import attr
 from mautrix.client import Client as MatrixClient, SyncStream
 from mautrix.errors import DecryptionError
 from mautrix.types import (
+    JSON,
     BaseMessageEventContentFuncs,
     EncryptedEvent,
     Event,
+    EventContent,
     EventID,
     EventType,
     Format,
@@ -35,11 +37,16 @@ from mautrix.types import (
     MessageType,
     RelatesTo,
     RoomID,
+    StateEvent,
     TextMessageEventContent,
 )
 from mautrix.util import markdown
 from mautrix.util.formatter import EntityType, MarkdownString, MatrixParser
 
+from .lib.coalesce import SendCoalescer
+from .lib.send_scheduler import SendPriority, SendScheduler
+from .lib.state_store import PgStateStore, StateBatch
+
 
 class HumanReadableString(MarkdownString):
     def format(self, entity_type: EntityType, **kwargs) -> MarkdownString:
@@ -152,7 +159,9 @@ class MaubotMessageEvent(MessageEvent):
         if extra_content:
             for k, v in extra_content.items():
                 content[k] = v
-        return await self.client.send_message_event(self.room_id, event_type, content)
+        return await self.client.send_message_event(
+            self.room_id, event_type, content, priority=SendPriority.HIGH
+        )
 
     def reply(
         self,
@@ -257,10 +266,72 @@ class MaubotMessageEvent(MessageEvent):
 
 class MaubotMatrixClient(MatrixClient):
     disable_replies: bool
+    send_scheduler: SendScheduler | None
+    coalescer: SendCoalescer | None
+    _state_batch: StateBatch | None
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.disable_replies = False
+        self.send_scheduler = None
+        self.coalescer = None
+        self._state_batch = None
+
+    async def send_message_event(
+        self,
+        room_id: RoomID,
+        event_type: EventType,
+        content: EventContent,
+        *args,
+        priority: SendPriority | None = None,
+        **kwargs,
+    ) -> EventID:
+        """
+        Send a message event to a room through the coalescer and the send scheduler, if they're
+        enabled.
+
+        Args:
+            room_id: The room to send the message to.
+            event_type: The type of the event.
+            content: The content of the event.
+            priority: The priority lane of the message. By default, notices are sent with low
+                priority and everything else with normal priority.
+            *args: Additional parameters to pass to :meth:`MatrixClient.send_message_event`.
+            **kwargs: Additional parameters to pass to :meth:`MatrixClient.send_message_event`.
+
+        Returns:
+            The ID of the event that was sent. If the message was merged with other messages,
+            this is the ID of the merged event.
+        """
+        if self.coalescer and not args and not kwargs:
+            event_id = await self.coalescer.send_message_event(
+                room_id, event_type, content, priority
+            )
+            if event_id is not None:
+                return event_id
+        return await self._send_scheduled(room_id, event_type, content, priority, *args, **kwargs)
+
+    async def _send_scheduled(
+        self,
+        room_id: RoomID,
+        event_type: EventType,
+        content: EventContent,
+        priority: SendPriority | None,
+        *args,
+        **kwargs,
+    ) -> EventID:
+        send = super().send_message_event
+        if not self.send_scheduler:
+            return await send(room_id, event_type, content, *args, **kwargs)
+        if priority is None:
+            if isinstance(content, dict):
+                msgtype = content.get("msgtype")
+            else:
+                msgtype = getattr(content, "msgtype", None)
+            priority = SendPriority.LOW if msgtype == MessageType.NOTICE else SendPriority.NORMAL
+        return await self.send_scheduler.send(
+            room_id, priority, lambda: send(room_id, event_type, content, *args, **kwargs)
+        )
 
     async def send_markdown(
         self,
@@ -292,11 +363,69 @@ class MaubotMatrixClient(MatrixClient):
                 content[k] = v
         return await self.send_message(room_id, content, **kwargs)
 
+    def _collect_state(self, data: JSON) -> StateBatch:
+        batch = StateBatch()
+        rooms = data.get("rooms", {})
+        sections = [
+            (room_id, room_data.get(section, {}).get("events", []))
+            for room_id, room_data in rooms.get("join", {}).items()
+            for section in ("state", "timeline")
+        ] + [
+            (room_id, room_data.get("timeline", {}).get("events", []))
+            for room_id, room_data in rooms.get("leave", {}).items()
+        ]
+        for room_id, events in sections:
+            for raw_event in events:
+                if "state_key" in raw_event:
+                    raw_event["room_id"] = room_id
+                    self.state_store.add_to_batch(batch, raw_event)
+        return batch
+
+    def handle_sync(self, data: JSON) -> list[asyncio.Task]:
+        if not isinstance(self.state_store, PgStateStore):
+            return super().handle_sync(data)
+        batch = self._collect_state(data)
+        if not batch:
+            return super().handle_sync(data)
+        task = asyncio.create_task(self._handle_sync_batched(data, batch))
+        # If the sync is cancelled before the batch is persisted, the events this batch claimed
+        # must be released so that the next batch containing them persists them instead
+        task.add_done_callback(lambda _: self.state_store.release_batch(batch))
+        return [task]
+
+    async def _handle_sync_batched(self, data: JSON, batch: StateBatch) -> None:
+        try:
+            await self.state_store.update_state_batch(batch)
+        except Exception:
+            self.log.exception(
+                f"Failed to persist batch of {len(batch)} state events, "
+                "falling back to persisting them individually"
+            )
+            batch = None
+        # handle_sync is synchronous, so the batch can't leak into other syncs
+        self._state_batch = batch
+        try:
+            tasks = super().handle_sync(data)
+        finally:
+            self._state_batch = None
+        await asyncio.gather(*tasks)
+
+    async def _update_state(self, evt: Event) -> None:
+        if getattr(evt, "state_persisted", False):
+            return
+        await super()._update_state(evt)
+
     def dispatch_event(self, event: Event, source: SyncStream) -> list[asyncio.Task]:
         if isinstance(event, MessageEvent) and not isinstance(event, MaubotMessageEvent):
             event = MaubotMessageEvent(event, self)
         elif source != SyncStream.INTERNAL:
             event.client = self
+        if (
+            self._state_batch is not None
+            and isinstance(event, StateEvent)
+            and self._state_batch.mark_persisted(event)
+        ):
+            setattr(event, "state_persisted", True)
         return super().dispatch_event(event, source)
 
     async def get_event(self, room_id: RoomID, event_id: EventID) -> Event:
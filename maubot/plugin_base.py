@@ -32,6 +32,8 @@ if TYPE_CHECKING:
     from sqlalchemy.engine.base import Engine
 
     from .client import MaubotMatrixClient
+    from .lib.dispatch_limiter import DispatchLimiter, RoomSerializer
+    from .lib.legacy_db import LegacyDatabaseExecutor
     from .loader import BasePluginLoader
     from .plugin_server import PluginWebApp
 
@@ -46,6 +48,8 @@ class Plugin(ABC):
     sched: BasicScheduler
     config: BaseProxyConfig | None
     database: Engine | Database | None
+    database_executor: LegacyDatabaseExecutor | None
+    dispatch_limiter: DispatchLimiter | RoomSerializer | None
     webapp: PluginWebApp | None
     webapp_url: URL | None
 
@@ -61,6 +65,8 @@ class Plugin(ABC):
         webapp: PluginWebApp | None,
         webapp_url: str | None,
         loader: BasePluginLoader,
+        database_executor: LegacyDatabaseExecutor | None = None,
+        dispatch_limiter: DispatchLimiter | RoomSerializer | None = None,
     ) -> None:
         self.sched = BasicScheduler(log=log.getChild("scheduler"))
         self.client = client
@@ -70,6 +76,11 @@ class Plugin(ABC):
         self.log = log
         self.config = config
         self.database = database
+        # For legacy SQLAlchemy databases, runs queries in a separate thread
+        self.database_executor = database_executor
+        # Limits how many event handlers of this instance can run at the same time, and
+        # optionally makes them handle the events of each room one at a time
+        self.dispatch_limiter = dispatch_limiter
         self.webapp = webapp
         self.webapp_url = URL(webapp_url) if webapp_url else None
         self.loader = loader
@@ -88,9 +99,10 @@ class Plugin(ABC):
                 continue
             try:
                 if val.__mb_event_handler__:
+                    handler = self.dispatch_limiter.wrap(val) if self.dispatch_limiter else val
                     for event_type in val.__mb_event_types__:
-                        self._handlers_at_startup.append((val, event_type))
-                        self.client.add_event_handler(event_type, val)
+                        self._handlers_at_startup.append((handler, event_type))
+                        self.client.add_event_handler(event_type, handler)
             except AttributeError:
                 pass
             try:
@@ -127,6 +139,8 @@ class Plugin(ABC):
         await self.pre_stop()
         for func, event_type in self._handlers_at_startup:
             self.client.remove_event_handler(event_type, func)
+        if self.dispatch_limiter:
+            self.dispatch_limiter.stop()
         if self.webapp is not None:
             self.webapp.clear()
         self.sched.stop()
@@ -29,20 +29,48 @@ class PluginWebApp(web.UrlDispatcher):
     def __init__(self):
         super().__init__()
         self._middleware: list[Middleware] = []
+        self._handler_chains: dict[web.AbstractRoute, Handler] = {}
 
     def add_middleware(self, middleware: Middleware) -> None:
         self._middleware.append(middleware)
+        self._handler_chains = {}
 
     def remove_middleware(self, middleware: Middleware) -> None:
         self._middleware.remove(middleware)
+        self._handler_chains = {}
+
+    @property
+    def is_empty(self) -> bool:
+        """Whether the app has neither routes nor middlewares, i.e. can only respond with 404."""
+        return not self._resources and not self._middleware
 
     def clear(self) -> None:
         self._resources = []
         self._named_resources = {}
         self._middleware = []
+        self._handler_chains = {}
         self._resource_index = {}
         self._matched_sub_app_resources = []
 
+    def _get_handler_chain(self, match_info: web.UrlMappingMatchInfo) -> Handler:
+        if not self._middleware:
+            return match_info.handler
+        elif match_info.http_exception is not None:
+            # Error match infos have a new route every time, so don't cache them
+            return self._compose_handler_chain(match_info.handler)
+        try:
+            return self._handler_chains[match_info.route]
+        except KeyError:
+            chain = self._handler_chains[match_info.route] = self._compose_handler_chain(
+                match_info.handler
+            )
+            return chain
+
+    def _compose_handler_chain(self, handler: Handler) -> Handler:
+        for middleware in self._middleware:
+            handler = partial(middleware, handler=handler)
+        return handler
+
     async def handle(self, request: web.Request) -> web.StreamResponse:
         match_info = await self.resolve(request)
         match_info.freeze()
@@ -53,10 +81,7 @@ class PluginWebApp(web.UrlDispatcher):
             resp = await match_info.expect_handler(request)
             await request.writer.drain()
         if resp is None:
-            handler = match_info.handler
-            for middleware in self._middleware:
-                handler = partial(middleware, handler=handler)
-            resp = await handler(request)
+            resp = await self._get_handler_chain(match_info)(request)
         return resp
 
 
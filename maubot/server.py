@@ -15,7 +15,6 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-from typing import Callable
 import asyncio
 import importlib.resources as resources
 import json
@@ -30,6 +29,7 @@ from mautrix.api import Method, PathBuilder
 
 from .__meta__ import __version__
 from .config import Config
+from .lib.static_files import CACHE_IMMUTABLE, StaticFile, read_directory
 from .plugin_server import PluginWebApp, PrefixResource
 
 
@@ -44,13 +44,17 @@ class AccessLogger(AbstractAccessLogger):
 
 class MaubotServer:
     log: logging.Logger = logging.getLogger("maubot.server")
+    plugin_base_path: str
     plugin_routes: dict[str, PluginWebApp]
+    ui_files: list[StaticFile]
 
     def __init__(
         self, management_api: web.Application, config: Config, loop: asyncio.AbstractEventLoop
     ) -> None:
         self.loop = loop or asyncio.get_event_loop()
-        self.app = web.Application(loop=self.loop, client_max_size=100 * 1024 * 1024)
+        self.app = web.Application(
+            loop=self.loop, client_max_size=config["server.max_request_size"]
+        )
         self.config = config
 
         self.setup_appservice()
@@ -61,36 +65,42 @@ class MaubotServer:
         self.runner = web.AppRunner(self.app, access_log_class=AccessLogger)
 
     async def handle_plugin_path(self, request: web.Request) -> web.StreamResponse:
-        for path, app in self.plugin_routes.items():
-            if request.path.startswith(path):
-                request = request.clone(
-                    rel_url=request.rel_url.with_path(
-                        request.rel_url.path[len(path) - 1 :]
-                    ).with_query(request.query_string)
-                )
-                return await app.handle(request)
-        return web.Response(status=404)
+        path = request.rel_url.path
+        if not path.startswith(self.plugin_base_path):
+            return web.Response(status=404)
+        instance_id, slash, _ = path[len(self.plugin_base_path) :].partition("/")
+        try:
+            app = self.plugin_routes[instance_id]
+        except KeyError:
+            return web.Response(status=404)
+        if not slash or app.is_empty:
+            # Nothing in the app could see the request, so skip cloning it
+            return web.Response(status=404)
+        subpath = path[len(self.plugin_base_path) + len(instance_id) :]
+        rel_url = URL.build(path=subpath, query_string=request.query_string)
+        # Plugin routes and middlewares see paths relative to the instance, so requests that
+        # reach the app have to be cloned with the new URL
+        return await app.handle(request.clone(rel_url=rel_url))
 
     def get_instance_subapp(self, instance_id: str) -> tuple[PluginWebApp, str]:
-        subpath = self.config["server.plugin_base_path"] + instance_id + "/"
-        url = self.config["server.public_url"] + subpath
+        url = self.config["server.public_url"] + self.plugin_base_path + instance_id + "/"
         try:
-            return self.plugin_routes[subpath], url
+            return self.plugin_routes[instance_id], url
         except KeyError:
             app = PluginWebApp()
-            self.plugin_routes[subpath] = app
+            self.plugin_routes[instance_id] = app
             return app, url
 
     def remove_instance_webapp(self, instance_id: str) -> None:
         try:
-            subpath = self.config["server.plugin_base_path"] + instance_id + "/"
-            self.plugin_routes.pop(subpath).clear()
+            self.plugin_routes.pop(instance_id).clear()
         except KeyError:
             return
 
     def setup_instance_subapps(self) -> None:
+        self.plugin_base_path = self.config["server.plugin_base_path"]
         self.plugin_routes = {}
-        resource = PrefixResource(self.config["server.plugin_base_path"].rstrip("/"))
+        resource = PrefixResource(self.plugin_base_path.rstrip("/"))
         resource.add_route(hdrs.METH_ANY, self.handle_plugin_path)
         self.app.router.register_resource(resource)
 
@@ -109,47 +119,33 @@ class MaubotServer:
                 resource_dir, pathlib.Path
             ), "Resources must be available on disk (use override_resource_path to specify custom path)"
             directory = str(resource_dir)
-        self.app.router.add_static(f"{ui_base}/static", f"{directory}/static")
-        self.setup_static_root_files(directory, ui_base)
-
-        with open(f"{directory}/index.html", "r") as file:
-            index_html = file.read()
-
-        @web.middleware
-        async def frontend_404_middleware(request: web.Request, handler) -> web.Response:
-            if hasattr(handler, "__self__") and isinstance(handler.__self__, web.StaticResource):
-                try:
-                    return await handler(request)
-                except web.HTTPNotFound:
-                    return web.Response(body=index_html, content_type="text/html")
-            return await handler(request)
+        # The frontend build has content hashes in all filenames under /static,
+        # so they can be cached forever.
+        static_files = read_directory(f"{directory}/static", cache_control=CACHE_IMMUTABLE)
+        index_html = StaticFile.read(f"{directory}/index.html")
+        self.ui_files = [index_html, *static_files.values()]
+
+        async def serve_static(request: web.Request) -> web.Response:
+            try:
+                file = static_files[request.match_info["path"]]
+            except KeyError:
+                file = index_html
+            return file.respond(request)
 
         async def ui_base_redirect(_: web.Request) -> web.Response:
             raise web.HTTPFound(f"{ui_base}/")
 
-        self.app.middlewares.append(frontend_404_middleware)
-        self.app.router.add_get(
-            f"{ui_base}/", lambda _: web.Response(body=index_html, content_type="text/html")
-        )
+        self.app.router.add_get(f"{ui_base}/static/{{path:.+}}", serve_static)
+        self.setup_static_root_files(directory, ui_base)
+        self.app.router.add_get(f"{ui_base}/", index_html.handle)
         self.app.router.add_get(ui_base, ui_base_redirect)
 
-    @staticmethod
-    def _static_data(data: bytes, mime: str) -> Callable[[web.Request], web.Response]:
-        def fn(_: web.Request) -> web.Response:
-            return web.Response(body=data, content_type=mime)
-
-        return fn
-
     def setup_static_root_files(self, directory: str, ui_base: str) -> None:
-        files = {
-            "asset-manifest.json": "application/json",
-            "manifest.json": "application/json",
-            "favicon.png": "image/png",
-        }
-        for file, mime in files.items():
-            with open(f"{directory}/{file}", "rb") as stream:
-                data = stream.read()
-            self.app.router.add_get(f"{ui_base}/{file}", self._static_data(data, mime))
+        files = ("asset-manifest.json", "manifest.json", "favicon.png")
+        for file in files:
+            static_file = StaticFile.read(f"{directory}/{file}")
+            self.ui_files.append(static_file)
+            self.app.router.add_get(f"{ui_base}/{file}", static_file.handle)
 
         public_url = self.config["server.public_url"]
         public_url_path = ""
@@ -159,17 +155,23 @@ class MaubotServer:
         api_path = f"{public_url_path}/_matrix/maubot/v1"
 
         path_prefix_response_body = json.dumps({"api_path": api_path.rstrip("/")})
-        self.app.router.add_get(
-            f"{ui_base}/paths.json",
-            lambda _: web.Response(
-                body=path_prefix_response_body, content_type="application/json"
-            ),
-        )
+        paths_file = StaticFile(path_prefix_response_body.encode("utf-8"), "application/json")
+        self.app.router.add_get(f"{ui_base}/paths.json", paths_file.handle)
+
+    def _precompress_ui_files(self) -> None:
+        try:
+            for file in self.ui_files:
+                file.precompress()
+        except Exception:
+            self.log.exception("Failed to precompress management UI files")
 
     def add_route(self, method: Method, path: PathBuilder, handler) -> None:
         self.app.router.add_route(method.value, str(path), handler)
 
     async def start(self) -> None:
+        # Compressing the frontend takes a while, so do it in the background. Files will be
+        # served uncompressed until their compressed variants are ready.
+        self.loop.run_in_executor(None, self._precompress_ui_files)
         await self.runner.setup()
         site = web.TCPSite(self.runner, self.config["server.hostname"], self.config["server.port"])
         await site.start()
@@ -0,0 +1,87 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import gc
+import tracemalloc
+import weakref
+
+import pytest
+
+from maubot import MessageEvent, Plugin
+from maubot.handlers import command, event
+
+# Imported under another name so that pytest doesn't try to collect it as a test class
+from maubot.testing.bot import TestBot as MockBot
+from mautrix.types import EventType
+from mautrix.util.logging import TraceLogger
+
+
+class RestartedPlugin(Plugin):
+    @command.new("foo", help="Do foo")
+    async def foo(self, evt: MessageEvent) -> None:
+        await evt.reply("foo")
+
+    @foo.subcommand("bar", help="Do bar")
+    async def bar(self, evt: MessageEvent) -> None:
+        await evt.reply("bar")
+
+    @event.on(EventType.ROOM_MESSAGE)
+    async def on_message(self, evt: MessageEvent) -> None:
+        pass
+
+
+async def restart(bot: MockBot, instance_id: str) -> weakref.ref:
+    plugin = RestartedPlugin(
+        client=bot.client,
+        loop=asyncio.get_running_loop(),
+        http=None,
+        instance_id=instance_id,
+        log=TraceLogger("test"),
+        config=None,
+        database=None,
+        webapp=None,
+        webapp_url=None,
+        loader=None,
+    )
+    await plugin.internal_start()
+    # Access the bound handlers and their cached help like a running instance would
+    assert plugin.foo.__mb_full_help__
+    assert plugin.foo.__mb_subcommands__[0] is plugin.bar
+    await plugin.internal_stop()
+    return weakref.ref(plugin)
+
+
+@pytest.mark.asyncio
+async def test_restart_does_not_leak_instances():
+    """Bound command handlers must not keep stopped plugin instances alive."""
+    bot = MockBot()
+    # Warm up caches that are filled once per process
+    for i in range(50):
+        await restart(bot, f"warmup{i}")
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        refs = [await restart(bot, f"instance{i}") for i in range(1000)]
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+        await bot.client.api.session.close()
+    assert sum(ref() is not None for ref in refs) == 0
+    # The weakrefs themselves take some memory, but the instances and handlers mustn't
+    assert growth < 256 * 1024, f"memory grew by {growth} bytes over 1000 restarts"
+    assert not bot.client.event_handlers.get(EventType.ROOM_MESSAGE)
@@ -0,0 +1,90 @@
+# maubot - A plugin-based Matrix bot system.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+from maubot.server import MaubotServer
+
+BASE_PATH = "/_matrix/maubot/plugin/"
+
+
+def make_server() -> MaubotServer:
+    # Only the plugin routing parts of the server are needed
+    server = MaubotServer.__new__(MaubotServer)
+    server.config = {"server.plugin_base_path": BASE_PATH, "server.public_url": ""}
+    server.app = web.Application()
+    server.setup_instance_subapps()
+    return server
+
+
+async def handle_hook(request: web.Request) -> web.Response:
+    return web.Response(text=f"{request.path}?{request.query_string}")
+
+
+@pytest.mark.asyncio
+async def test_dispatch_by_instance_id():
+    server = make_server()
+    for i in range(3):
+        app, _ = server.get_instance_subapp(f"bot{i}")
+        app.add_get("/hook", handle_hook)
+    resp = await server.handle_plugin_path(make_mocked_request("GET", f"{BASE_PATH}bot1/hook?a=b"))
+    assert resp.status == 200 and resp.text == "/hook?a=b"
+    for path in (f"{BASE_PATH}bot9/hook", f"{BASE_PATH}bot1", f"{BASE_PATH}bot1x/hook"):
+        resp = await server.handle_plugin_path(make_mocked_request("GET", path))
+        assert resp.status == 404, path
+
+
+@pytest.mark.asyncio
+async def test_middleware_without_routes():
+    server = make_server()
+    app, _ = server.get_instance_subapp("bot")
+    seen = []
+
+    async def middleware(request: web.Request, handler) -> web.StreamResponse:
+        seen.append(request.path)
+        return web.Response(status=204)
+
+    app.add_middleware(middleware)
+    resp = await server.handle_plugin_path(make_mocked_request("GET", f"{BASE_PATH}bot/any"))
+    assert resp.status == 204 and seen == ["/any"]
+
+
+async def dispatch_rate(instance_count: int, iterations: int = 2000) -> float:
+    """Requests per second to the last registered of ``instance_count`` instance webapps."""
+    server = make_server()
+    for i in range(instance_count):
+        app, _ = server.get_instance_subapp(f"bot{i}")
+        app.add_post("/webhook", handle_hook)
+    request = make_mocked_request("POST", f"{BASE_PATH}bot{instance_count - 1}/webhook")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        resp = await server.handle_plugin_path(request)
+    duration = time.perf_counter() - start
+    assert resp.status == 200
+    return iterations / duration
+
+
+@pytest.mark.asyncio
+async def test_dispatch_benchmark():
+    """Dispatching must not get slower as more instances register webapps."""
+    # Warm up the code paths so that the first measurement isn't penalized
+    await dispatch_rate(10)
+    few = await dispatch_rate(10)
+    many = await dispatch_rate(1000)
+    assert many > few / 2, f"10 instances: {few:.0f} req/s, 1000 instances: {many:.0f} req/s"